@@ -25,12 +25,20 @@ from apscheduler.schedulers.background import BackgroundScheduler
 from pyrogram import Client
 
 from plugins import glovar
-from plugins.functions.timers import backup_files, interval_hour_01, reset_data
+from plugins.functions.channel import send_digest, share_batch, share_scores
+from plugins.functions.etc import start_pools, start_timer, stop_pools, undelay
+from plugins.functions.file import save_all
+from plugins.functions.group import resume_deletes, save_deletes
+from plugins.functions.timers import backup_files, expire_reports, interval_hour_01, interval_min_10, reset_data
 from plugins.functions.timers import update_admins, update_report_ids, update_status
 
 # Enable logging
 logger = logging.getLogger(__name__)
 
+# Start the worker pools and the timer
+start_pools()
+start_timer()
+
 # Config session
 app = Client(
     session_name="bot",
@@ -38,11 +46,16 @@ app = Client(
 )
 app.start()
 
+# Resume the pending deletions
+resume_deletes(app)
+
 # Send online status
 update_status(app, "online")
 
 # Timer
 scheduler = BackgroundScheduler(job_defaults={"misfire_grace_time": 60})
+scheduler.add_job(expire_reports, "interval", [app], minutes=1)
+scheduler.add_job(interval_min_10, "interval", minutes=10)
 scheduler.add_job(interval_hour_01, "interval", [app], hours=1)
 scheduler.add_job(update_status, "cron", [app, "awake"], minute=30)
 scheduler.add_job(backup_files, "cron", [app], hour=20)
@@ -54,5 +67,26 @@ scheduler.start()
 # Hold
 app.idle()
 
+# Keep the pending deletions
+save_deletes()
+
+# Share the pending scores
+undelay("share_scores")
+share_scores(app)
+
+# Share the collected exchange records
+undelay("share_batch")
+share_batch(app)
+
+# Send the collected debug entries
+undelay("digest")
+send_digest(app)
+
+# Finish the queued tasks
+stop_pools()
+
 # Stop
 app.stop()
+
+# Flush the data
+save_all()
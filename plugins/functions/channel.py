@@ -24,15 +24,41 @@ from pyrogram import Chat, Client, Message
 from pyrogram.errors import FloodWait
 
 from .. import glovar
-from .etc import code, code_block, general_link, get_full_name, get_command_type, lang
-from .etc import message_link, thread, wait_flood
-from .file import crypt_file, delete_file, get_new_path, save
+from .etc import code, code_block, delay, general_link, get_full_name, get_command_type, lang
+from .etc import message_link, thread, undelay
+from .file import crypt_file, data_to_file, delete_file, get_new_path, save_user
+from .rate import take_token, wait_flood
 from .telegram import get_group_info, get_user_bio, send_document, send_message
 
 # Enable logging
 logger = logging.getLogger(__name__)
 
 
+def add_digest(client: Client, chat: Chat, text: str) -> bool:
+    # Add a debug entry to the digest, the digest is sent when the window ends
+    try:
+        header = chat.id not in glovar.digest_entries and get_debug_text(client, chat)
+
+        glovar.locks["digest"].acquire()
+        try:
+            first = not glovar.digest_entries
+
+            if chat.id not in glovar.digest_entries:
+                glovar.digest_entries[chat.id] = [header or get_debug_text(client, chat)]
+
+            glovar.digest_entries[chat.id].append(text)
+        finally:
+            glovar.locks["digest"].release()
+
+        first and delay(glovar.digest, send_digest, [client], "digest", priority="debug")
+
+        return True
+    except Exception as e:
+        logger.warning(f"Add digest error: {e}", exc_info=True)
+
+    return False
+
+
 def ask_for_help(client: Client, level: str, gid: int, uid: int, group: str = "single") -> bool:
     # Let USER help to delete all message from user, or ban user globally
     try:
@@ -79,7 +105,7 @@ def exchange_to_hide(client: Client) -> bool:
         text = (f"{lang('project')}{lang('colon')}{code(glovar.sender)}\n"
                 f"{lang('issue')}{lang('colon')}{code(lang('exchange_invalid'))}\n"
                 f"{lang('auto_fix')}{lang('colon')}{code(lang('protocol_1'))}\n")
-        thread(send_message, (client, glovar.critical_channel_id, text))
+        thread(send_message, (client, glovar.critical_channel_id, text), priority="debug")
 
         return True
     except Exception as e:
@@ -185,13 +211,14 @@ def forward_evidence(client: Client, message: Message, level: str,
         while flood_wait:
             flood_wait = False
             try:
+                take_token("forward_messages", glovar.logging_channel_id)
                 result = message.forward(
                     chat_id=glovar.logging_channel_id,
                     disable_notification=True
                 )
             except FloodWait as e:
                 flood_wait = True
-                wait_flood(e)
+                wait_flood(e, "forward_messages", glovar.logging_channel_id)
             except Exception as e:
                 logger.info(f"Forward evidence message error: {e}", exc_info=True)
                 return False
@@ -204,6 +231,12 @@ def forward_evidence(client: Client, message: Message, level: str,
     return result
 
 
+def get_batch_length(records: List[dict]) -> int:
+    # Get the length of the batch envelope as it is sent in the exchange channel
+    receivers = sorted({receiver for record in records for receiver in record["to"]})
+    return len(format_data(glovar.sender, receivers, "batch", "text", records))
+
+
 def get_debug_text(client: Client, context: Union[int, Chat, List[int]]) -> str:
     # Get a debug message text prefix
     text = ""
@@ -240,10 +273,9 @@ def send_debug(client: Client, message: Message, action: str, uid: int, aid: int
                reason: str = None) -> bool:
     # Send the debug message
     try:
-        text = get_debug_text(client, message.chat)
-        text += (f"{lang('user_id')}{lang('colon')}{code(uid)}\n"
-                 f"{lang('action')}{lang('colon')}{code(action)}\n"
-                 f"{lang('admin_group')}{lang('colon')}{code(aid)}\n")
+        text = (f"{lang('user_id')}{lang('colon')}{code(uid)}\n"
+                f"{lang('action')}{lang('colon')}{code(action)}\n"
+                f"{lang('admin_group')}{lang('colon')}{code(aid)}\n")
 
         if em:
             text += f"{lang('stored_message')}{lang('colon')}{general_link(em.message_id, message_link(em))}\n"
@@ -258,20 +290,96 @@ def send_debug(client: Client, message: Message, action: str, uid: int, aid: int
             if reason:
                 text += f"{lang('reason')}{lang('colon')}{code(reason)}\n"
 
-        thread(send_message, (client, glovar.debug_channel_id, text))
+        # Collect the entry for the digest
+        if glovar.digest:
+            return add_digest(client, message.chat, text)
+
+        text = get_debug_text(client, message.chat) + text
+        thread(send_message, (client, glovar.debug_channel_id, text), priority="debug")
     except Exception as e:
         logger.warning(f"Send debug error: {e}", exc_info=True)
 
     return False
 
 
+def send_digest(client: Client) -> bool:
+    # Send the collected debug entries, split at the length limit of a message
+    try:
+        glovar.locks["digest"].acquire()
+        try:
+            digest_entries = glovar.digest_entries
+            glovar.digest_entries = {}
+        finally:
+            glovar.locks["digest"].release()
+
+        text = ""
+        last_gid = 0
+
+        for gid in digest_entries:
+            header, *entries = digest_entries[gid]
+
+            for entry in entries:
+                # Every message starts with the header of its first group
+                piece = (text and gid == last_gid and entry) or f"{header}\n{entry}"
+
+                if text and len(text) + len(piece) + 1 > 4096:
+                    thread(send_message, (client, glovar.debug_channel_id, text), priority="debug")
+                    text = ""
+                    piece = f"{header}\n{entry}"
+
+                text += (text and f"\n{piece}") or piece
+                last_gid = gid
+
+        text and thread(send_message, (client, glovar.debug_channel_id, text), priority="debug")
+
+        return True
+    except Exception as e:
+        logger.warning(f"Send digest error: {e}", exc_info=True)
+
+    return False
+
+
+def share_batch(client: Client, records: List[dict] = None) -> bool:
+    # Share the collected records in one envelope
+    try:
+        if records is None:
+            glovar.locks["batch"].acquire()
+            try:
+                records = glovar.batch_records
+                glovar.batch_records = []
+            finally:
+                glovar.locks["batch"].release()
+
+        if not records:
+            return True
+
+        receivers = sorted({receiver for record in records for receiver in record["to"]})
+
+        # Send the envelope as an encrypted document if it is too long for a message
+        if get_batch_length(records) > glovar.batch_limit:
+            file = data_to_file(records)
+            return share_data_thread(client, receivers, "batch", "file", None, file, True)
+
+        return share_data_thread(client, receivers, "batch", "text", records)
+    except Exception as e:
+        logger.warning(f"Share batch error: {e}", exc_info=True)
+
+    return False
+
+
 def share_data(client: Client, receivers: List[str], action: str, action_type: str,
                data: Union[bool, dict, int, str] = None, file: str = None, encrypt: bool = True) -> bool:
     # Use this function to share data in the channel
     try:
+        # Collect the text records in batch mode
+        if glovar.batch and not file and action != "batch":
+            return share_record(client, receivers, action, action_type, data)
+
         thread(
             target=share_data_thread,
-            args=(client, receivers, action, action_type, data, file, encrypt)
+            args=(client, receivers, action, action_type, data, file, encrypt),
+            pool="share",
+            priority="share"
         )
 
         return True
@@ -318,7 +426,7 @@ def share_data_thread(client: Client, receivers: List[str], action: str, action_
             # Delete the tmp file
             if result:
                 for f in {file, file_path}:
-                    f.startswith("tmp/") and thread(delete_file, (f,))
+                    f.startswith("tmp/") and thread(delete_file, (f,), "file")
         else:
             text = format_data(
                 sender=glovar.sender,
@@ -333,7 +441,7 @@ def share_data_thread(client: Client, receivers: List[str], action: str, action_
         if result is False and not glovar.should_hide:
             # Use hide channel instead
             exchange_to_hide(client)
-            thread(share_data, (client, receivers, action, action_type, data, file, encrypt))
+            share_data(client, receivers, action, action_type, data, file, encrypt)
 
         return True
     except Exception as e:
@@ -342,25 +450,105 @@ def share_data_thread(client: Client, receivers: List[str], action: str, action_
     return False
 
 
-def update_score(client: Client, uid: int) -> bool:
-    # Update a user's score, share it
+def share_record(client: Client, receivers: List[str], action: str, action_type: str,
+                 data: Union[bool, dict, int, str] = None) -> bool:
+    # Add a record to the batch, the batch is shared when the window ends or it is large enough
+    try:
+        record = {
+            "to": [receiver for receiver in receivers if receiver != glovar.sender],
+            "action": action,
+            "type": action_type,
+            "data": data
+        }
+
+        if not record["to"]:
+            return True
+
+        glovar.locks["batch"].acquire()
+        try:
+            previous = []
+            records = glovar.batch_records + [record]
+            length = get_batch_length(records)
+
+            # Measure the envelope as it is sent, the record starts a new batch if the message would be too long
+            if length > glovar.batch_limit and glovar.batch_records:
+                previous = glovar.batch_records
+                records = [record]
+                length = get_batch_length(records)
+
+            glovar.batch_records = records
+            first = len(records) == 1
+            full = length >= glovar.batch_limit
+        finally:
+            glovar.locks["batch"].release()
+
+        previous and thread(share_batch, (client, previous), "share", "share")
+
+        if full:
+            undelay("share_batch")
+            thread(share_batch, (client,), "share", "share")
+        elif first:
+            delay(glovar.batch, share_batch, [client], "share_batch", "share", "share")
+
+        return True
+    except Exception as e:
+        logger.warning(f"Share record error: {e}", exc_info=True)
+
+    return False
+
+
+def share_scores(client: Client) -> bool:
+    # Share the pending scores
+    try:
+        glovar.locks["score"].acquire()
+        try:
+            score_pending = glovar.score_pending
+            glovar.score_pending = {}
+        finally:
+            glovar.locks["score"].release()
+
+        for uid, score in score_pending.items():
+            share_data(
+                client=client,
+                receivers=glovar.receivers["score"],
+                action="update",
+                action_type="score",
+                data={
+                    "id": uid,
+                    "score": score
+                }
+            )
+
+        return True
+    except Exception as e:
+        logger.warning(f"Share scores error: {e}", exc_info=True)
+
+    return False
+
+
+def update_score(client: Client, uid: int, flush: bool = False) -> bool:
+    # Update a user's score, share the latest score of each user once per interval
     try:
-        ban_count = len(glovar.user_ids[uid]["ban"])
-        kick_count = len(glovar.user_ids[uid]["kick"])
-        warn_count = len(glovar.user_ids[uid]["warn"])
+        ban_count = len(glovar.user_ids[uid].get("ban", ()))
+        kick_count = len(glovar.user_ids[uid].get("kick", ()))
+        warn_count = len(glovar.user_ids[uid].get("warn", ()))
         score = ban_count * 1 + kick_count * 0.3 + warn_count * 0.4
         glovar.user_ids[uid]["score"][glovar.sender.lower()] = score
-        save("user_ids")
-        share_data(
-            client=client,
-            receivers=glovar.receivers["score"],
-            action="update",
-            action_type="score",
-            data={
-                "id": uid,
-                "score": round(score, 1)
-            }
-        )
+        save_user(uid)
+
+        glovar.locks["score"].acquire()
+        try:
+            first = not glovar.score_pending
+            glovar.score_pending[uid] = round(score, 1)
+        finally:
+            glovar.locks["score"].release()
+
+        # Share the pending scores now, so a ban is not held back by the interval
+        if flush:
+            undelay("share_scores")
+            thread(share_scores, (client,), "share", "share")
+        elif first:
+            delay(glovar.score_interval, share_scores, [client], "share_scores", "share", "share")
 
         return True
     except Exception as e:
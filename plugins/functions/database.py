@@ -0,0 +1,295 @@
+# SCP-079-WARN - Warn or ban someone by admin commands
+# Copyright (C) 2019 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-WARN.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import pickle
+from collections import OrderedDict
+from sqlite3 import Connection, connect
+from threading import Lock
+from weakref import WeakValueDictionary
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+# Enable logging
+logger = logging.getLogger(__name__)
+
+# The connection is shared by all threads
+lock = Lock()
+
+
+class Cache(OrderedDict):
+    # A dict that loads the missing items from a table on demand, only the recently used items are kept,
+    # an evicted item that is still referenced is used again, so the changes made to it are not lost
+
+    def __init__(self, conn: Connection, table: str, convert: Optional[Callable[[Any], Any]] = None,
+                 limit: int = 100000):
+        super().__init__()
+        self.conn = conn
+        self.convert = convert
+        self.evicted: WeakValueDictionary = WeakValueDictionary()
+        self.limit = limit
+        self.lock = Lock()
+        self.missing: OrderedDict = OrderedDict()
+        self.table = table
+
+    def __contains__(self, key: Any) -> bool:
+        return self.get(key) is not None
+
+    def __getitem__(self, key: Any) -> Any:
+        value = self.get(key)
+
+        if value is None:
+            raise KeyError(key)
+
+        return value
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        self.lock.acquire()
+        try:
+            super().__setitem__(key, value)
+            self.move_to_end(key)
+            self.evicted.pop(key, None)
+            self.missing.pop(key, None)
+            self.evict()
+        finally:
+            self.lock.release()
+
+    def evict(self) -> None:
+        # Drop the least recently used items and missing keys, the caller holds the lock
+        while len(self) > self.limit:
+            key, value = self.popitem(last=False)
+
+            try:
+                self.evicted[key] = value
+            except TypeError:
+                pass
+
+        while len(self.missing) > self.limit:
+            self.missing.popitem(last=False)
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        self.lock.acquire()
+        try:
+            if OrderedDict.__contains__(self, key):
+                self.move_to_end(key)
+                return OrderedDict.__getitem__(self, key)
+
+            # The key is known to be missing in the table
+            if key in self.missing:
+                self.missing.move_to_end(key)
+                return default
+
+            # The table may not have the changes of the evicted item yet
+            value = self.evicted.pop(key, None)
+
+            if value is not None:
+                OrderedDict.__setitem__(self, key, value)
+                self.evict()
+                return value
+        finally:
+            self.lock.release()
+
+        value = self.load(key)
+
+        if value is None:
+            return default
+
+        return value
+
+    def load(self, key: Any) -> Any:
+        # Load an item from the table, keep it in the cache, or remember that it is missing
+        value = get_row(self.conn, self.table, key)
+
+        if value is not None and self.convert:
+            value = self.convert(value)
+
+        self.lock.acquire()
+        try:
+            # Another thread may have set or evicted it in the meantime
+            if OrderedDict.__contains__(self, key):
+                return OrderedDict.__getitem__(self, key)
+
+            value = self.evicted.pop(key, None) or value
+
+            if value is None:
+                self.missing[key] = True
+            else:
+                OrderedDict.__setitem__(self, key, value)
+
+            self.evict()
+        finally:
+            self.lock.release()
+
+        return value
+
+    def pop(self, key: Any, default: Any = None) -> Any:
+        self.lock.acquire()
+        try:
+            self.evicted.pop(key, None)
+            return super().pop(key, default)
+        finally:
+            self.lock.release()
+
+
+class Rows:
+    # The rows of a table, pickled as a dict while they are read page by page
+
+    def __init__(self, conn: Connection, table: str):
+        self.conn = conn
+        self.count = 0
+        self.table = table
+
+    def __iter__(self) -> Iterator[Tuple[Any, Any]]:
+        for key, value in iter_rows(self.conn, self.table):
+            self.count += 1
+            yield key, value
+
+    def __reduce__(self):
+        return dict, (), None, None, iter(self)
+
+
+def dump_rows(conn: Connection, table: str, file: BinaryIO) -> int:
+    # Pickle a table as a dict to the file without loading the whole table, return the count of the rows
+    rows = Rows(conn, table)
+    pickler = pickle.Pickler(file)
+
+    # Do not memoize the rows, or all of them are kept until the end
+    pickler.fast = True
+    pickler.dump(rows)
+
+    return rows.count
+
+
+def get_database(path: str, tables: Iterable[str]) -> Connection:
+    # Open the database in WAL mode, create the tables
+    conn = connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+
+    for table in tables:
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (id PRIMARY KEY, data BLOB NOT NULL)")
+
+    conn.commit()
+
+    return conn
+
+
+def get_row(conn: Connection, table: str, key: Any) -> Any:
+    # Get a row's value
+    result = None
+    try:
+        lock.acquire()
+        try:
+            row = conn.execute(f"SELECT data FROM {table} WHERE id = ?", (key,)).fetchone()
+        finally:
+            lock.release()
+
+        if row:
+            result = pickle.loads(row[0])
+    except Exception as e:
+        logger.warning(f"Get row {key} from {table} error: {e}", exc_info=True)
+
+    return result
+
+
+def get_rows(conn: Connection, table: str) -> Optional[Dict[Any, Any]]:
+    # Get all rows of a table
+    result = None
+    try:
+        lock.acquire()
+        try:
+            rows = conn.execute(f"SELECT id, data FROM {table}").fetchall()
+        finally:
+            lock.release()
+
+        result = {key: pickle.loads(data) for key, data in rows}
+    except Exception as e:
+        logger.warning(f"Get rows from {table} error: {e}", exc_info=True)
+
+    return result
+
+
+def iter_rows(conn: Connection, table: str, size: int = 1000) -> Iterator[Tuple[Any, Any]]:
+    # Iterate the rows of a table, the lock is only held to read a page of them
+    last = None
+
+    while True:
+        lock.acquire()
+        try:
+            if last is None:
+                rows = conn.execute(f"SELECT id, data FROM {table} ORDER BY id LIMIT ?", (size,)).fetchall()
+            else:
+                rows = conn.execute(f"SELECT id, data FROM {table} WHERE id > ? ORDER BY id LIMIT ?",
+                                    (last, size)).fetchall()
+        finally:
+            lock.release()
+
+        for key, data in rows:
+            yield key, pickle.loads(data)
+
+        if len(rows) < size:
+            return
+
+        last = rows[-1][0]
+
+
+def set_row(conn: Connection, table: str, key: Any, value: Any) -> bool:
+    # Write a row through, delete it if the value is None
+    try:
+        if value is None:
+            sql, parameters = f"DELETE FROM {table} WHERE id = ?", (key,)
+        else:
+            sql, parameters = f"INSERT OR REPLACE INTO {table} VALUES (?, ?)", (key, pickle.dumps(value))
+
+        lock.acquire()
+        try:
+            with conn:
+                conn.execute(sql, parameters)
+        finally:
+            lock.release()
+
+        return True
+    except Exception as e:
+        logger.warning(f"Set row {key} in {table} error: {e}", exc_info=True)
+
+    return False
+
+
+def set_rows(conn: Connection, table: str, data: Dict[Any, Any], replace: bool = True) -> bool:
+    # Write all items of a dict in one transaction, delete the rows of None values, replace the whole table by default
+    try:
+        items = list(data.items())
+        rows = [(key, pickle.dumps(value)) for key, value in items if value is not None]
+        keys = [(key,) for key, value in items if value is None]
+
+        lock.acquire()
+        try:
+            with conn:
+                replace and conn.execute(f"DELETE FROM {table}")
+                conn.executemany(f"DELETE FROM {table} WHERE id = ?", keys)
+                conn.executemany(f"INSERT OR REPLACE INTO {table} VALUES (?, ?)", rows)
+        finally:
+            lock.release()
+
+        return True
+    except Exception as e:
+        logger.warning(f"Set rows in {table} error: {e}", exc_info=True)
+
+    return False
@@ -17,17 +17,18 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+from heapq import heapify, heappop, heappush
 from html import escape
 from json import dumps, loads
-from random import choice, uniform
+from queue import Full, Queue
+from random import choice
 from string import ascii_letters, digits
-from threading import Thread, Timer
-from time import sleep, time
-from typing import Any, Callable, List, Optional, Union
+from threading import Thread
+from time import time
+from typing import Any, Callable, List, Optional, Tuple, Union
 
 from cryptography.fernet import Fernet
 from pyrogram import CallbackQuery, InlineKeyboardMarkup, Message, User
-from pyrogram.errors import FloodWait
 
 from .. import glovar
 
@@ -106,16 +107,33 @@ def crypt_str(operation: str, text: str, key: str) -> str:
     return result
 
 
-def delay(secs: int, target: Callable, args: list) -> bool:
-    # Call a function with delay
+def delay(secs: float, target: Callable, args: list, key: str = None,
+          pool: str = "telegram", priority: str = "report", replace: bool = True) -> bool:
+    # Call a function with delay, a task with the same key replaces the pending one, or is dropped if not replace
+    glovar.timer_condition.acquire()
     try:
-        t = Timer(secs, target, args)
-        t.daemon = True
-        t.start()
+        if not replace and key in glovar.timer_jobs:
+            return True
+
+        glovar.timer_count += 1
+        seq = glovar.timer_count
+        key = key or f"_{seq}"
+        when = time() + secs
+        glovar.timer_jobs[key] = (when, seq, target, args, pool, priority)
+        heappush(glovar.timer_heap, (when, seq, key))
+
+        # Drop the cancelled entries if they take most of the heap
+        if len(glovar.timer_heap) > 1024 and len(glovar.timer_heap) > len(glovar.timer_jobs) * 2:
+            glovar.timer_heap = [(j[0], j[1], k) for k, j in glovar.timer_jobs.items()]
+            heapify(glovar.timer_heap)
+
+        glovar.timer_condition.notify()
 
         return True
     except Exception as e:
         logger.warning(f"Delay error: {e}", exc_info=True)
+    finally:
+        glovar.timer_condition.release()
 
     return False
 
@@ -216,6 +234,20 @@ def get_command_type(message: Message) -> str:
     return result
 
 
+def get_delayed(target: Callable) -> List[Tuple[float, list]]:
+    # Get the pending delayed tasks of a function
+    result = []
+    glovar.timer_condition.acquire()
+    try:
+        result = [(j[0], j[3]) for j in glovar.timer_jobs.values() if j[2] is target]
+    except Exception as e:
+        logger.warning(f"Get delayed error: {e}", exc_info=True)
+    finally:
+        glovar.timer_condition.release()
+
+    return result
+
+
 def get_full_name(user: User) -> str:
     # Get user's full name
     text = ""
@@ -353,27 +385,219 @@ def t2t(text: str, normal: bool, printable: bool) -> str:
     return text
 
 
-def thread(target: Callable, args: tuple) -> bool:
-    # Call a function using thread
+def ordered(key: str, target: Callable, args: tuple) -> bool:
+    # Call a function in the ordered queue of the key, the calls of the same key run one by one
+    try:
+        # Run in the calling thread after the pools are stopped
+        if glovar.pool_stopped:
+            target(*args)
+            return True
+
+        glovar.locks["ordered"].acquire()
+        try:
+            queue = glovar.ordered_queues.get(key)
+
+            # Each key has its own consumer
+            if queue is None:
+                queue = Queue(1000)
+                glovar.ordered_queues[key] = queue
+                t = Thread(target=ordered_worker, args=(key,), name=key)
+                t.daemon = True
+                t.start()
+                glovar.pool_threads.append(t)
+        finally:
+            glovar.locks["ordered"].release()
+
+        # Block the caller if the consumer falls behind, so the order is kept
+        queue.put((target, args))
+
+        return True
+    except Exception as e:
+        logger.warning(f"Ordered error: {e}", exc_info=True)
+
+    return False
+
+
+def ordered_worker(key: str) -> bool:
+    # Run the tasks of an ordered queue
+    queue = glovar.ordered_queues[key]
+
+    while True:
+        target, args = queue.get()
+
+        # Stop signal
+        if target is None:
+            return True
+
+        try:
+            target(*args)
+        except Exception as e:
+            logger.warning(f"Ordered {key} task {target.__name__} error: {e}", exc_info=True)
+
+
+def pool_worker(pool: str) -> bool:
+    # Run the tasks of a worker pool
+    queue = glovar.pools[pool]
+
+    while True:
+        _, _, priority, target, args = queue.get()
+
+        # Stop signal
+        if target is None:
+            return True
+
+        # Let the rate limiter know the priority of the running task
+        glovar.priority_local.name = priority
+
+        try:
+            target(*args)
+        except Exception as e:
+            logger.warning(f"Pool {pool} task {target.__name__} error: {e}", exc_info=True)
+
+
+def start_pools() -> bool:
+    # Start the workers of all pools
+    try:
+        for pool in glovar.pools:
+            for i in range(glovar.pool_sizes[pool]):
+                t = Thread(target=pool_worker, args=(pool,), name=f"{pool}_{i}")
+                t.daemon = True
+                t.start()
+                glovar.pool_threads.append(t)
+
+        return True
+    except Exception as e:
+        logger.warning(f"Start pools error: {e}", exc_info=True)
+
+    return False
+
+
+def stop_pools(timeout: float = 30.0) -> bool:
+    # Let the workers finish the queued tasks, then stop them
     try:
-        t = Thread(target=target, args=args)
+        glovar.pool_stopped = True
+
+        # The stop signals are queued after the tasks of all priorities
+        for pool in glovar.pools:
+            for _ in range(glovar.pool_sizes[pool]):
+                glovar.pools[pool].put((len(glovar.priorities), next(glovar.pool_count), "", None, None))
+
+        glovar.locks["ordered"].acquire()
+        try:
+            for queue in glovar.ordered_queues.values():
+                queue.put((None, None))
+        finally:
+            glovar.locks["ordered"].release()
+
+        deadline = time() + timeout
+
+        for t in glovar.pool_threads:
+            t.join(max(deadline - time(), 0))
+
+        return True
+    except Exception as e:
+        logger.warning(f"Stop pools error: {e}", exc_info=True)
+
+    return False
+
+
+def start_timer() -> bool:
+    # Start the thread of delayed tasks
+    try:
+        t = Thread(target=timer_worker, name="timer")
         t.daemon = True
         t.start()
 
         return True
     except Exception as e:
-        logger.warning(f"Thread error: {e}", exc_info=True)
+        logger.warning(f"Start timer error: {e}", exc_info=True)
 
     return False
 
 
-def wait_flood(e: FloodWait) -> bool:
-    # Wait flood secs
+def thread(target: Callable, args: tuple, pool: str = "telegram", priority: str = "report",
+           inline: bool = True) -> bool:
+    # Call a function using the worker pool, the tasks with higher priority run first,
+    # return False if the pool is full and the caller may not run the task inline
     try:
-        sleep(e.x + uniform(0.5, 1.0))
+        # Run in the calling thread after the pools are stopped
+        if glovar.pool_stopped:
+            target(*args)
+            return True
+
+        try:
+            task = (glovar.priorities[priority], next(glovar.pool_count), priority, target, args)
+
+            if inline:
+                glovar.pools[pool].put(task, timeout=glovar.pool_timeout)
+            else:
+                glovar.pools[pool].put_nowait(task)
+        except Full:
+            if not inline:
+                return False
+
+            # Back pressure, the caller does the work itself if the pool is too busy
+            logger.info(f"Pool {pool} is full, run {target.__name__} directly")
+            target(*args)
 
         return True
     except Exception as e:
-        logger.warning(f"Wait flood error: {e}", exc_info=True)
+        logger.warning(f"Thread error: {e}", exc_info=True)
 
     return False
+
+
+def timer_worker() -> bool:
+    # Hand the due delayed tasks over to the worker pools
+    while True:
+        due = []
+        glovar.timer_condition.acquire()
+        try:
+            while True:
+                heap = glovar.timer_heap
+                now = time()
+
+                while heap and heap[0][0] <= now:
+                    _, seq, key = heappop(heap)
+                    job = glovar.timer_jobs.get(key)
+
+                    # Cancelled or replaced
+                    if not job or job[1] != seq:
+                        continue
+
+                    glovar.timer_jobs.pop(key, None)
+                    due.append((key, job))
+
+                if due:
+                    break
+
+                if heap:
+                    glovar.timer_condition.wait(heap[0][0] - now)
+                else:
+                    glovar.timer_condition.wait()
+        except Exception as e:
+            logger.warning(f"Timer worker error: {e}", exc_info=True)
+        finally:
+            glovar.timer_condition.release()
+
+        # The timer never runs a task itself, the task waits on the heap again if its pool is full
+        for key, (_, _, target, args, pool, priority) in due:
+            if thread(target, tuple(args), pool, priority, False):
+                continue
+
+            logger.info(f"Pool {pool} is full, delay {target.__name__} again")
+            delay(glovar.pool_timeout, target, args, key, pool, priority, False)
+
+
+def undelay(key: str) -> bool:
+    # Cancel a pending delayed task
+    result = False
+    glovar.timer_condition.acquire()
+    try:
+        result = glovar.timer_jobs.pop(key, None) is not None
+    except Exception as e:
+        logger.warning(f"Undelay error: {e}", exc_info=True)
+    finally:
+        glovar.timer_condition.release()
+
+    return result
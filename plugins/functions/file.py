@@ -17,23 +17,61 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-from os import remove
+from os import fsync, remove, rename, replace
 from os.path import exists
-from pickle import dump
-from shutil import copyfile
+from pickle import dump, dumps
+from shutil import copyfileobj
+from threading import Lock
 from typing import Any
 
 from pyAesCrypt import decryptFile, encryptFile
 from pyrogram import Client
 
 from .. import glovar
-from .etc import random_str, thread
+from .database import Cache, set_row, set_rows
+from .etc import delay, random_str
+from .status import UserStatus
+from .structures import ExpiringMap
 from .telegram import download_media
 
 # Enable logging
 logger = logging.getLogger(__name__)
 
 
+def copy_data(data: Any, deep: bool = False) -> Any:
+    # Copy the containers of the data one by one, each single copy holds the GIL, so it is never torn,
+    # the user records are only copied if deep, otherwise the snapshot shares them with the live data
+    if isinstance(data, ExpiringMap):
+        # Only copy the live items
+        data.expire()
+        return dict(data)
+
+    if isinstance(data, dict):
+        result = data.copy() if type(data) is dict else dict(list(data.items()))
+
+        # Only visit the values that need a copy, a table of users is not walked in Python
+        for key, value in result.items():
+            if isinstance(value, (dict, list, set, tuple)) or (deep and isinstance(value, UserStatus)):
+                result[key] = copy_data(value, deep)
+
+        return result
+
+    if isinstance(data, set):
+        return data.copy()
+
+    if isinstance(data, list):
+        return [copy_data(value, deep) for value in list(data)]
+
+    if isinstance(data, tuple):
+        return tuple(copy_data(value, deep) for value in data)
+
+    # Each container of a user record is pickled in one step, but the record can change between them
+    if deep and isinstance(data, UserStatus):
+        return data.copy()
+
+    return data
+
+
 def crypt_file(operation: str, file_in: str, file_out: str) -> bool:
     # Encrypt or decrypt a file
     try:
@@ -81,6 +119,11 @@ def delete_file(path: str) -> bool:
     return False
 
 
+def freeze_data(data: Any, deep: bool = False) -> bytes:
+    # Take a copy of the data, then pickle the copy, copy the user records too if deep
+    return dumps(copy_data(data, deep))
+
+
 def get_downloaded_path(client: Client, file_id: str, file_ref: str) -> str:
     # Download file, get it's path on local machine
     final_path = ""
@@ -112,10 +155,81 @@ def get_new_path(extension: str = "") -> str:
     return result
 
 
-def save(file: str) -> bool:
-    # Save a global variable to a file
+def mark_shard(uid: int = None) -> bool:
+    # Mark the user's shard of user_ids as dirty, or all the shards
+    try:
+        if not glovar.sharded:
+            return True
+
+        glovar.locks["save"].acquire()
+        try:
+            if uid is None:
+                glovar.shard_dirty = (1 << glovar.shards) - 1
+            else:
+                glovar.shard_dirty |= 1 << (uid % glovar.shards)
+        finally:
+            glovar.locks["save"].release()
+
+        return True
+    except Exception as e:
+        logger.warning(f"Mark shard error: {e}", exc_info=True)
+
+    return False
+
+
+def rotate_journal() -> bool:
+    # Move the journal of user_ids aside before taking a full snapshot
+    glovar.locks["journal"].acquire()
+    try:
+        if not exists("data/user_ids.log"):
+            return True
+
+        if exists("data/user_ids.log.1"):
+            # The last compaction failed, keep its records
+            with open("data/user_ids.log", "rb") as f_in, open("data/user_ids.log.1", "ab") as f_out:
+                copyfileobj(f_in, f_out)
+
+            remove("data/user_ids.log")
+        else:
+            rename("data/user_ids.log", "data/user_ids.log.1")
+
+        glovar.journal_count = 0
+
+        return True
+    except Exception as e:
+        logger.error(f"Rotate journal error: {e}", exc_info=True)
+    finally:
+        glovar.locks["journal"].release()
+
+    return False
+
+
+def save(file: str, key: Any = None) -> bool:
+    # Mark a global variable as dirty, it will be saved after the save interval
     try:
-        thread(save_thread, (file,))
+        # Only the user's shard has changed if the uid is given
+        file == "user_ids" and mark_shard(key)
+
+        glovar.locks["save"].acquire()
+        try:
+            # Only the rows of the changed keys are written in sqlite mode, None stands for the whole table
+            if glovar.sqlite and file in glovar.sqlite_list:
+                keys = glovar.save_keys.setdefault(file, set())
+
+                if key is None:
+                    glovar.save_keys[file] = None
+                elif keys is not None:
+                    keys.add(key)
+
+            # Coalesce with the save that is already scheduled
+            if file in glovar.save_pending:
+                return True
+
+            glovar.save_pending.add(file)
+        finally:
+            glovar.locks["save"].release()
+
+        delay(glovar.save_interval, save_thread, [file], pool="file")
 
         return True
     except Exception as e:
@@ -124,19 +238,176 @@ def save(file: str) -> bool:
     return False
 
 
+def save_all() -> bool:
+    # Save all dirty files immediately, wait for the in-flight saves
+    try:
+        for file in list(glovar.save_pending):
+            save_thread(file)
+
+        for lock in list(glovar.save_locks.values()):
+            lock.acquire()
+            lock.release()
+
+        return True
+    except Exception as e:
+        logger.warning(f"Save all error: {e}", exc_info=True)
+
+    return False
+
+
+def save_user(uid: int) -> bool:
+    # Save a single user's status, append it to the journal in journal mode
+    try:
+        # Write through to the database in sqlite mode
+        if glovar.sqlite:
+            return set_row(glovar.database, "user_ids", uid, copy_data(glovar.user_ids.get(uid), True))
+
+        if not glovar.journal:
+            return save("user_ids", uid)
+
+        mark_shard(uid)
+
+        # Take the snapshot in the lock, so the records of a user are appended in the order they are taken
+        glovar.locks["journal"].acquire()
+        try:
+            record = freeze_data((uid, glovar.user_ids.get(uid)), True)
+
+            with open("data/user_ids.log", "ab") as f:
+                f.write(record)
+
+            glovar.journal_count += 1
+        finally:
+            glovar.locks["journal"].release()
+
+        return True
+    except Exception as e:
+        logger.warning(f"Save user error: {e}", exc_info=True)
+
+    return False
+
+
+def save_shards() -> bool:
+    # Save the dirty shards of user_ids
+    glovar.locks["save"].acquire()
+    dirty, glovar.shard_dirty = glovar.shard_dirty, 0
+    glovar.locks["save"].release()
+
+    try:
+        if not dirty:
+            return True
+
+        shards = [i for i in range(glovar.shards) if dirty & (1 << i)]
+
+        for i in shards:
+            if not write_data(f"data/user_ids.{i}", glovar.user_ids.get_shard(i), True):
+                raise IOError(f"failed to write shard {i}")
+
+            dirty &= ~(1 << i)
+
+            glovar.locks["save"].acquire()
+            glovar.shard_backup |= 1 << i
+            glovar.locks["save"].release()
+
+        return True
+    except Exception as e:
+        logger.error(f"Save shards error: {e}", exc_info=True)
+
+        # Try again next time
+        glovar.locks["save"].acquire()
+        glovar.shard_dirty |= dirty
+        glovar.locks["save"].release()
+
+    return False
+
+
 def save_thread(file: str) -> bool:
     # Save thread
+    saved = False
+    lock = glovar.save_locks.setdefault(file, Lock())
+    lock.acquire()
     try:
         if not glovar:
+            saved = True
             return True
 
-        with open(f"data/.{file}", "wb") as f:
-            dump(eval(f"glovar.{file}"), f)
+        # Saves requested from now on should be scheduled again
+        glovar.locks["save"].acquire()
+        try:
+            glovar.save_pending.discard(file)
+        finally:
+            glovar.locks["save"].release()
+
+        # Write the changed rows or the whole table in sqlite mode
+        if glovar.sqlite and file in glovar.sqlite_list:
+            glovar.locks["save"].acquire()
+            try:
+                keys = glovar.save_keys.pop(file, None)
+            finally:
+                glovar.locks["save"].release()
+
+            data = eval(f"glovar.{file}")
+
+            if keys is not None:
+                saved = set_rows(glovar.database, file, {key: copy_data(data.get(key), True) for key in keys}, False)
+            else:
+                # The items not in the cache are still up to date
+                saved = set_rows(glovar.database, file, copy_data(data, True), not isinstance(data, Cache))
+
+            # Write the whole table next time
+            if not saved:
+                glovar.locks["save"].acquire()
+                glovar.save_keys[file] = None
+                glovar.locks["save"].release()
+
+            return saved
+
+        # The snapshot of user_ids contains everything in the journal
+        rotated = file == "user_ids" and rotate_journal()
+
+        if file == "user_ids" and glovar.sharded:
+            saved = save_shards()
+        else:
+            saved = write_data(f"data/{file}", eval(f"glovar.{file}"), file == "user_ids")
 
-        copyfile(f"data/.{file}", f"data/{file}")
+        saved and rotated and delete_file("data/user_ids.log.1")
 
-        return True
+        return saved
     except Exception as e:
         logger.error(f"Save thread error: {e}", exc_info=True)
+    finally:
+        lock.release()
+
+        # Keep the file dirty and try again later, save_all() will also pick it up
+        if not saved:
+            glovar.locks["save"].acquire()
+            try:
+                retry = file not in glovar.save_pending
+                glovar.save_pending.add(file)
+            finally:
+                glovar.locks["save"].release()
+
+            retry and delay(glovar.save_interval, save_thread, [file], pool="file")
+
+    return False
+
+
+def write_data(path: str, data: Any, deep: bool = False) -> bool:
+    # Write the data to a temp file, then atomically replace the target file
+    # The caller holds the save lock of the file, so the snapshots of a file are written in the order they are taken
+    try:
+        # Take the snapshot first, the slow disk I/O happens after it
+        content = freeze_data(data, deep)
+        temp_path = get_new_path()
+
+        with open(temp_path, "wb") as f:
+            f.write(content)
+            f.flush()
+            fsync(f.fileno())
+
+        replace(temp_path, path)
+
+        return True
+    except Exception as e:
+        logger.error(f"Write data to {path} error: {e}", exc_info=True)
 
     return False
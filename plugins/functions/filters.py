@@ -244,10 +244,8 @@ def is_class_e_user(user: Union[int, User]) -> bool:
         if uid in glovar.bot_ids:
             return True
 
-        group_list = list(glovar.admin_ids)
-        for gid in group_list:
-            if uid in glovar.admin_ids.get(gid, set()):
-                return True
+        if glovar.admin_groups.get(uid):
+            return True
     except Exception as e:
         logger.warning(f"Is class e user error: {e}", exc_info=True)
 
@@ -257,7 +255,9 @@ def is_class_e_user(user: Union[int, User]) -> bool:
 def is_declared_message_id(gid: int, mid: int) -> bool:
     # Check if the message's ID is declared by other bots
     try:
-        if mid in glovar.declared_message_ids.get(gid, set()):
+        declared = glovar.declared_message_ids.get(gid)
+
+        if declared and mid in declared:
             return True
     except Exception as e:
         logger.warning(f"Is declared message id error: {e}", exc_info=True)
@@ -17,27 +17,66 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+from os import remove
+from os.path import exists
+from pickle import load
+from time import time
 from typing import Optional
 
 from pyrogram import Client, Message
 
 from .. import glovar
-from .etc import code, lang, thread
-from .file import save
+from .etc import code, delay, get_delayed, lang, thread, undelay
+from .file import save, write_data
+from .ids import set_admin_ids
 from .telegram import delete_messages, get_messages, leave_chat
 
 # Enable logging
 logger = logging.getLogger(__name__)
 
 
+def delete_batch(client: Client, gid: int) -> bool:
+    # Delete the collected messages of a chat
+    try:
+        glovar.locks["delete"].acquire()
+        try:
+            mids = glovar.delete_ids.pop(gid, set())
+        finally:
+            glovar.locks["delete"].release()
+
+        if not mids:
+            return True
+
+        delete_messages(client, gid, sorted(mids))
+
+        return True
+    except Exception as e:
+        logger.warning(f"Delete batch error: {e}", exc_info=True)
+
+    return False
+
+
 def delete_message(client: Client, gid: int, mid: int) -> bool:
-    # Delete a single message
+    # Delete a single message, the deletions of a chat are sent in batches
     try:
         if not gid or not mid:
             return True
 
-        mids = [mid]
-        thread(delete_messages, (client, gid, mids))
+        # Cancel the pending delayed deletion of the message
+        undelay(f"delete_{gid}_{mid}")
+
+        glovar.locks["delete"].acquire()
+        try:
+            # Join the batch that is already scheduled
+            if gid in glovar.delete_ids:
+                glovar.delete_ids[gid].add(mid)
+                return True
+
+            glovar.delete_ids[gid] = {mid}
+        finally:
+            glovar.locks["delete"].release()
+
+        delay(glovar.delete_interval, delete_batch, [client, gid], f"batch_{gid}", priority="enforce")
 
         return True
     except Exception as e:
@@ -96,17 +135,64 @@ def leave_group(client: Client, gid: int) -> bool:
         save("left_group_ids")
         thread(leave_chat, (client, gid))
 
-        glovar.admin_ids.pop(gid, None)
-        save("admin_ids")
+        set_admin_ids(gid, None)
+        save("admin_ids", gid)
 
         glovar.message_ids.pop(gid, (0, 0))
         save("message_ids")
 
         glovar.configs.pop(gid, None)
-        save("configs")
+        save("configs", gid)
+
+        glovar.declared_message_ids.pop(gid, None)
 
         return True
     except Exception as e:
         logger.warning(f"Leave group error: {e}", exc_info=True)
 
     return False
+
+
+def resume_deletes(client: Client) -> bool:
+    # Reschedule the pending deletions saved before the last restart
+    try:
+        if not exists("data/deletes"):
+            return True
+
+        with open("data/deletes", "rb") as f:
+            deletes = load(f)
+
+        remove("data/deletes")
+        now = time()
+
+        for when, cid, mids in deletes:
+            delay(max(when - now, 0), delete_messages, [client, cid, mids], f"delete_{cid}_{mids[0]}")
+
+        return True
+    except Exception as e:
+        logger.warning(f"Resume deletes error: {e}", exc_info=True)
+
+    return False
+
+
+def save_deletes() -> bool:
+    # Save the pending deletions, so they can be resumed after restart
+    try:
+        deletes = [(when, args[1], [args[2]]) for when, args in get_delayed(delete_message)]
+        deletes += [(when, args[1], list(args[2])) for when, args in get_delayed(delete_messages)]
+
+        # The batches that have not been sent yet
+        glovar.locks["delete"].acquire()
+        try:
+            deletes += [(time(), gid, sorted(mids)) for gid, mids in glovar.delete_ids.items() if mids]
+        finally:
+            glovar.locks["delete"].release()
+
+        if not deletes:
+            return True
+
+        return write_data("data/deletes", deletes)
+    except Exception as e:
+        logger.warning(f"Save deletes error: {e}", exc_info=True)
+
+    return False
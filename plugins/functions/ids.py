@@ -18,14 +18,39 @@
 
 import logging
 from copy import deepcopy
+from typing import Optional, Set
 
 from .. import glovar
-from .file import save
+from .database import Cache, set_rows
+from .file import save, save_user
+from .status import UserStatus, load_status
+from .structures import RotatingSet, ShardedMap
 
 # Enable logging
 logger = logging.getLogger(__name__)
 
 
+def index_admin_ids() -> bool:
+    # Rebuild the groups of each admin from the whole admin list
+    glovar.locks["index"].acquire()
+    try:
+        admin_groups = {}
+
+        for gid, admins in list(glovar.admin_ids.items()):
+            for uid in admins:
+                admin_groups.setdefault(uid, set()).add(gid)
+
+        glovar.admin_groups = admin_groups
+
+        return True
+    except Exception as e:
+        logger.warning(f"Index admin ids error: {e}", exc_info=True)
+    finally:
+        glovar.locks["index"].release()
+
+    return False
+
+
 def init_group_id(gid: int) -> bool:
     # Init group data
     try:
@@ -37,7 +62,7 @@ def init_group_id(gid: int) -> bool:
 
         if glovar.admin_ids.get(gid) is None:
             glovar.admin_ids[gid] = set()
-            save("admin_ids")
+            save("admin_ids", gid)
 
         if glovar.message_ids.get(gid) is None:
             glovar.message_ids[gid] = (0, 0)
@@ -45,13 +70,13 @@ def init_group_id(gid: int) -> bool:
 
         if glovar.configs.get(gid) is None:
             glovar.configs[gid] = deepcopy(glovar.default_config)
-            save("configs")
+            save("configs", gid)
 
         if glovar.counts.get(gid) is None:
             glovar.counts[gid] = {}
 
         if glovar.declared_message_ids.get(gid) is None:
-            glovar.declared_message_ids[gid] = set()
+            glovar.declared_message_ids[gid] = RotatingSet(glovar.declared_window, glovar.declared_limit)
 
         return True
     except Exception as e:
@@ -64,11 +89,62 @@ def init_user_id(uid: int) -> bool:
     # Init user data
     try:
         if glovar.user_ids.get(uid) is None:
-            glovar.user_ids[uid] = deepcopy(glovar.default_user_status)
-            save("user_ids")
+            glovar.user_ids[uid] = UserStatus()
+            save_user(uid)
 
         return True
     except Exception as e:
         logger.warning(f"Init user id {uid} error: {e}", exc_info=True)
 
     return False
+
+
+def reset_user_ids(data: Optional[dict] = None) -> bool:
+    # Replace all the users, the users are still loaded from the table on demand in sqlite mode
+    try:
+        data = data or {}
+
+        if glovar.sqlite:
+            if not set_rows(glovar.database, "user_ids", data):
+                return False
+
+            glovar.user_ids = Cache(glovar.database, "user_ids", load_status, glovar.cache_size)
+        elif glovar.sharded:
+            glovar.user_ids = ShardedMap(glovar.shards, data)
+        else:
+            glovar.user_ids = data
+
+        return True
+    except Exception as e:
+        logger.warning(f"Reset user ids error: {e}", exc_info=True)
+
+    return False
+
+
+def set_admin_ids(gid: int, admins: Optional[Set[int]]) -> bool:
+    # Set a group's admin list and the groups of each admin, remove the group if admins is None
+    glovar.locks["index"].acquire()
+    try:
+        old = glovar.admin_ids.get(gid, set())
+        new = admins or set()
+
+        for uid in old - new:
+            groups = glovar.admin_groups.get(uid, set())
+            groups.discard(gid)
+            not groups and glovar.admin_groups.pop(uid, None)
+
+        for uid in new - old:
+            glovar.admin_groups.setdefault(uid, set()).add(gid)
+
+        if admins is None:
+            glovar.admin_ids.pop(gid, None)
+        else:
+            glovar.admin_ids[gid] = admins
+
+        return True
+    except Exception as e:
+        logger.warning(f"Set admin ids error: {e}", exc_info=True)
+    finally:
+        glovar.locks["index"].release()
+
+    return False
@@ -0,0 +1,133 @@
+# SCP-079-WARN - Warn or ban someone by admin commands
+# Copyright (C) 2019 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-WARN.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+from threading import Lock
+from time import sleep, time
+
+from .. import glovar
+
+# Enable logging
+logger = logging.getLogger(__name__)
+
+# Lock ordering, take the locks in this order to avoid deadlocks:
+# 1. Group locks, by ascending stripe
+# 2. User locks, by ascending stripe
+# 3. The locks in glovar.locks, never take a striped lock while holding one of them
+# The leases of try_lock() are not blocking locks, they only mark a user as being processed in a group
+
+
+def get_group_lock(gid: int) -> Lock:
+    # Get the striped lock of a group
+    return glovar.group_locks[gid % glovar.lock_stripes]
+
+
+def get_user_lock(uid: int) -> Lock:
+    # Get the striped lock of a user
+    return glovar.user_locks[uid % glovar.lock_stripes]
+
+
+def is_locked(uid: int, gid: int) -> bool:
+    # Check whether a user is being processed in a group
+    result = False
+    glovar.locks["lease"].acquire()
+    try:
+        result = glovar.user_leases.get((uid, gid), (0.0, 0))[0] > time()
+    except Exception as e:
+        logger.warning(f"Is locked error: {e}", exc_info=True)
+    finally:
+        glovar.locks["lease"].release()
+
+    return result
+
+
+def lock_all_users() -> bool:
+    # Acquire all the user locks, for the changes of the whole user data
+    try:
+        for lock in glovar.user_locks:
+            lock.acquire()
+
+        return True
+    except Exception as e:
+        logger.warning(f"Lock all users error: {e}", exc_info=True)
+
+    return False
+
+
+def try_lock(uid: int, gid: int, timeout: float = 0.0) -> int:
+    # Take the lease of a user in a group, return the token of the lease, or 0 if it is taken by others
+    # The lease expires if it is not released in time, then others may take it
+    try:
+        deadline = time() + timeout
+
+        while True:
+            glovar.locks["lease"].acquire()
+            try:
+                now = time()
+
+                if glovar.user_leases.get((uid, gid), (0.0, 0))[0] <= now:
+                    token = next(glovar.lease_count)
+                    glovar.user_leases[(uid, gid)] = (now + glovar.lock_lease, token)
+
+                    # Drop the expired leases that were never released
+                    if len(glovar.user_leases) > glovar.lease_limit:
+                        glovar.user_leases = {key: lease for key, lease in glovar.user_leases.items()
+                                              if lease[0] > now}
+                        glovar.lease_limit = max(1024, len(glovar.user_leases) * 2)
+
+                    return token
+            finally:
+                glovar.locks["lease"].release()
+
+            if now >= deadline:
+                return 0
+
+            sleep(min(0.1, deadline - now))
+    except Exception as e:
+        logger.warning(f"Try lock error: {e}", exc_info=True)
+
+    return 0
+
+
+def unlock(uid: int, gid: int, token: int) -> bool:
+    # Release the lease of a user in a group, unless the lease has expired and been taken by others
+    glovar.locks["lease"].acquire()
+    try:
+        if glovar.user_leases.get((uid, gid), (0.0, 0))[1] == token:
+            glovar.user_leases.pop((uid, gid), None)
+
+        return True
+    except Exception as e:
+        logger.warning(f"Unlock error: {e}", exc_info=True)
+    finally:
+        glovar.locks["lease"].release()
+
+    return False
+
+
+def unlock_all_users() -> bool:
+    # Release all the user locks
+    try:
+        for lock in reversed(glovar.user_locks):
+            lock.release()
+
+        return True
+    except Exception as e:
+        logger.warning(f"Unlock all users error: {e}", exc_info=True)
+
+    return False
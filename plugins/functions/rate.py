@@ -0,0 +1,173 @@
+# SCP-079-WARN - Warn or ban someone by admin commands
+# Copyright (C) 2019 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-WARN.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+from random import uniform
+from time import sleep, time
+from typing import Union
+
+from pyrogram.errors import FloodWait
+
+from .. import glovar
+
+# Enable logging
+logger = logging.getLogger(__name__)
+
+
+def get_limits(method: str, cid: Union[int, str] = 0) -> list:
+    # Get the buckets a request should take tokens from
+    result = []
+    try:
+        if glovar.rate_limits.get(method):
+            result.append((method, glovar.rate_limits[method]))
+
+        # Only the messages count towards the global and the per-chat limits
+        if not cid or not isinstance(cid, int) or method not in glovar.rate_messages:
+            return result
+
+        result.append(("global", glovar.rate_limits["global"]))
+
+        # The project's own channels are not limited like the groups
+        if cid in glovar.channel_ids:
+            return result
+
+        if cid < 0:
+            result.append((f"chat_{cid}", glovar.rate_limits["group"]))
+        else:
+            result.append((f"chat_{cid}", glovar.rate_limits["private"]))
+    except Exception as e:
+        logger.warning(f"Get limits error: {e}", exc_info=True)
+
+    return result
+
+
+def prune_buckets() -> bool:
+    # Remove the per-chat buckets that have been refilled
+    glovar.locks["rate"].acquire()
+    try:
+        now = time()
+
+        for key in list(glovar.rate_buckets):
+            if not key.startswith("chat_"):
+                continue
+
+            tokens, last = glovar.rate_buckets[key]
+            rate, size = glovar.rate_limits["group" if int(key[5:]) < 0 else "private"]
+
+            if tokens + (now - last) * rate >= size:
+                glovar.rate_buckets.pop(key, None)
+
+        return True
+    except Exception as e:
+        logger.warning(f"Prune buckets error: {e}", exc_info=True)
+    finally:
+        glovar.locks["rate"].release()
+
+    return False
+
+
+def take_token(method: str, cid: Union[int, str] = 0) -> bool:
+    # Wait until all the buckets of the request have a token, then take them together
+    try:
+        # Wait out the flood wait of the scope first
+        wait_scope(method, cid)
+
+        limits = get_limits(method, cid)
+
+        # The lower priorities leave some global tokens to the higher ones
+        priority = getattr(glovar.priority_local, "name", "report")
+        reserve = glovar.rate_reserves.get(priority, 0.0)
+
+        while limits:
+            wait = 0.0
+
+            glovar.locks["rate"].acquire()
+            try:
+                now = time()
+
+                for key, (rate, size) in limits:
+                    bucket = glovar.rate_buckets.setdefault(key, [size, now])
+                    bucket[0] = min(size, bucket[0] + (now - bucket[1]) * rate)
+                    bucket[1] = now
+
+                    need = 1 + (key == "global" and reserve)
+
+                    if bucket[0] < need:
+                        wait = max(wait, (need - bucket[0]) / rate)
+
+                if not wait:
+                    for key, _ in limits:
+                        glovar.rate_buckets[key][0] -= 1
+
+                    return True
+            finally:
+                glovar.locks["rate"].release()
+
+            sleep(wait)
+
+        return True
+    except Exception as e:
+        logger.warning(f"Take token error: {e}", exc_info=True)
+
+    return False
+
+
+def wait_flood(e: FloodWait, method: str, cid: Union[int, str] = 0) -> bool:
+    # Wait flood secs, the other requests of the same scope will wait too
+    try:
+        secs = e.x + uniform(0.5, 1.0)
+        scope = f"{method}_{cid}"
+
+        glovar.locks["rate"].acquire()
+        try:
+            glovar.flood_until[scope] = max(glovar.flood_until.get(scope, 0.0), time() + secs)
+            glovar.metrics["flood_count"] += 1
+        finally:
+            glovar.locks["rate"].release()
+
+        return wait_scope(method, cid)
+    except Exception as e:
+        logger.warning(f"Wait flood error: {e}", exc_info=True)
+
+    return False
+
+
+def wait_scope(method: str, cid: Union[int, str] = 0) -> bool:
+    # Wait until the flood wait of the scope is over
+    try:
+        scope = f"{method}_{cid}"
+
+        while True:
+            glovar.locks["rate"].acquire()
+            try:
+                until = glovar.flood_until.get(scope, 0.0)
+                secs = until - time()
+
+                if secs <= 0:
+                    until and glovar.flood_until.pop(scope, None)
+                    return True
+
+                glovar.metrics["flood_time"] += secs
+            finally:
+                glovar.locks["rate"].release()
+
+            sleep(secs)
+    except Exception as e:
+        logger.warning(f"Wait scope error: {e}", exc_info=True)
+
+    return False
@@ -18,19 +18,21 @@
 
 import logging
 import pickle
-from copy import deepcopy
 from json import loads
-from typing import Any
+from typing import Any, List, Set
 
 from pyrogram import Client, InlineKeyboardButton, InlineKeyboardMarkup, Message
 
 from .. import glovar
 from .channel import get_debug_text, share_data
 from .etc import code, crypt_str, general_link, get_int, get_text, lang, mention_id, thread
-from .file import crypt_file, data_to_file, delete_file, get_downloaded_path, get_new_path, save
+from .file import crypt_file, data_to_file, delete_file, get_downloaded_path, get_new_path, save, save_user
 from .filters import is_declared_message_id
 from .group import get_config_text, get_message, leave_group
-from .ids import init_group_id, init_user_id
+from .ids import index_admin_ids, init_group_id, init_user_id, reset_user_ids
+from .lock import get_user_lock, is_locked, lock_all_users, unlock_all_users
+from .status import UserStatus, load_status
+from .structures import ExpiringMap, ReportStore
 from .telegram import send_message, send_report_message
 from .timers import update_admins
 from .user import report_user
@@ -59,9 +61,37 @@ def receive_add_bad(data: dict) -> bool:
     return False
 
 
+def receive_batch_data(client: Client, message: Message, data: dict, senders: Set[str]) -> List[dict]:
+    # Unpack the records of a batch from the permitted senders, other data is a single record
+    result = []
+    try:
+        if data["action"] != "batch":
+            return [data]
+
+        if glovar.sender not in data["to"]:
+            return []
+
+        # Never download or unpickle the envelope of a sender without any route
+        if data["from"] not in senders:
+            return []
+
+        if data["type"] == "file":
+            records = receive_file_data(client, message)
+        else:
+            records = data["data"]
+
+        if not records:
+            return []
+
+        result = [{**record, "from": data["from"]} for record in records if isinstance(record, dict)]
+    except Exception as e:
+        logger.warning(f"Receive batch data error: {e}", exc_info=True)
+
+    return result
+
+
 def receive_clear_data(client: Client, data_type: str, data: dict) -> bool:
     # Receive clear data command
-    glovar.locks["message"].acquire()
     try:
         # Basic data
         aid = data["admin_id"]
@@ -79,7 +109,11 @@ def receive_clear_data(client: Client, data_type: str, data: dict) -> bool:
         # Clear user data
         if data_type == "user":
             if the_type == "all":
-                glovar.user_ids = {}
+                lock_all_users()
+                try:
+                    reset_user_ids()
+                finally:
+                    unlock_all_users()
 
             save("user_ids")
 
@@ -87,13 +121,13 @@ def receive_clear_data(client: Client, data_type: str, data: dict) -> bool:
         if data_type == "watch":
             if the_type == "all":
                 glovar.watch_ids = {
-                    "ban": {},
-                    "delete": {}
+                    "ban": ExpiringMap(),
+                    "delete": ExpiringMap()
                 }
             elif the_type == "ban":
-                glovar.watch_ids["ban"] = {}
+                glovar.watch_ids["ban"] = ExpiringMap()
             elif the_type == "delete":
-                glovar.watch_ids["delete"] = {}
+                glovar.watch_ids["delete"] = ExpiringMap()
 
             save("watch_ids")
 
@@ -102,11 +136,9 @@ def receive_clear_data(client: Client, data_type: str, data: dict) -> bool:
                 f"{lang('admin_project')}{lang('colon')}{mention_id(aid)}\n"
                 f"{lang('action')}{lang('colon')}{code(lang('clear'))}\n"
                 f"{lang('more')}{lang('colon')}{code(f'{data_type} {the_type}')}\n")
-        thread(send_message, (client, glovar.debug_channel_id, text))
+        thread(send_message, (client, glovar.debug_channel_id, text), priority="debug")
     except Exception as e:
         logger.warning(f"Receive clear data: {e}", exc_info=True)
-    finally:
-        glovar.locks["message"].release()
 
     return False
 
@@ -119,7 +151,7 @@ def receive_config_commit(data: dict) -> bool:
         config = data["config"]
 
         glovar.configs[gid] = config
-        save("configs")
+        save("configs", gid)
 
         return True
     except Exception as e:
@@ -247,7 +279,7 @@ def receive_file_data(client: Client, message: Message, decrypt: bool = True) ->
             data = pickle.load(f)
 
         for f in {path, path_decrypted}:
-            thread(delete_file, (f,))
+            thread(delete_file, (f,), "file")
     except Exception as e:
         logger.warning(f"Receive file error: {e}", exc_info=True)
 
@@ -277,9 +309,9 @@ def receive_help_report(client: Client, data: dict) -> bool:
             return True
 
         if not (init_user_id(0) and init_user_id(uid)
-                and gid not in glovar.user_ids[uid]["lock"]
-                and gid not in glovar.user_ids[uid]["waiting"]
-                and gid not in glovar.user_ids[uid]["ban"]):
+                and not is_locked(uid, gid)
+                and (uid, gid) not in glovar.waiting_ids
+                and gid not in glovar.user_ids[uid].get("ban", ())):
             return True
 
         the_message = get_message(client, gid, mid)
@@ -293,9 +325,9 @@ def receive_help_report(client: Client, data: dict) -> bool:
         if result:
             glovar.reports[key]["report_id"] = result.message_id
         else:
-            glovar.reports[key].pop(key, {})
+            glovar.reports.pop(key, {})
 
-        save("reports")
+        save("reports", key)
 
         return True
     except Exception as e:
@@ -326,7 +358,7 @@ def receive_leave_approve(client: Client, data: dict) -> bool:
             text += f"{lang('reason')}{lang('colon')}{code(reason)}\n"
 
         leave_group(client, the_id)
-        thread(send_message, (client, glovar.debug_channel_id, text))
+        thread(send_message, (client, glovar.debug_channel_id, text), priority="debug")
 
         return True
     except Exception as e:
@@ -348,7 +380,7 @@ def receive_refresh(client: Client, data: int) -> bool:
         text = (f"{lang('project')}{lang('colon')}{general_link(glovar.project_name, glovar.project_link)}\n"
                 f"{lang('admin_project')}{lang('colon')}{mention_id(aid)}\n"
                 f"{lang('action')}{lang('colon')}{code(lang('refresh'))}\n")
-        thread(send_message, (client, glovar.debug_channel_id, text))
+        thread(send_message, (client, glovar.debug_channel_id, text), priority="debug")
 
         return True
     except Exception as e:
@@ -370,8 +402,8 @@ def receive_remove_bad(data: dict) -> bool:
             glovar.watch_ids["ban"].pop(the_id, {})
             glovar.watch_ids["delete"].pop(the_id, {})
             save("watch_ids")
-            glovar.user_ids[the_id] = deepcopy(glovar.default_user_status)
-            save("user_ids")
+            glovar.user_ids[the_id] = UserStatus()
+            save_user(the_id)
 
         save("bad_ids")
 
@@ -384,22 +416,24 @@ def receive_remove_bad(data: dict) -> bool:
 
 def receive_remove_score(data: int) -> bool:
     # Receive remove user's score
-    glovar.locks["message"].acquire()
     try:
         # Basic data
         uid = data
 
-        if not glovar.user_ids.get(uid):
-            return True
+        lock = get_user_lock(uid)
+        lock.acquire()
+        try:
+            if not glovar.user_ids.get(uid):
+                return True
 
-        glovar.user_ids[uid] = deepcopy(glovar.default_user_status)
-        save("user_ids")
+            glovar.user_ids[uid] = UserStatus()
+            save_user(uid)
+        finally:
+            lock.release()
 
         return True
     except Exception as e:
         logger.warning(f"Receive remove score error: {e}", exc_info=True)
-    finally:
-        glovar.locks["message"].release()
 
     return False
 
@@ -435,15 +469,39 @@ def receive_rollback(client: Client, message: Message, data: dict) -> bool:
         if not the_data:
             return True
 
-        exec(f"glovar.{the_type} = the_data")
-        save(the_type)
+        # Rollback a shard of user_ids
+        if the_type.startswith("user_ids."):
+            shard = get_int(the_type.split(".")[1])
+
+            removed = glovar.user_ids.shard_keys(shard) if glovar.sharded else []
+
+            for uid in removed:
+                glovar.user_ids.pop(uid, None)
+
+            glovar.user_ids.update({uid: load_status(status) for uid, status in the_data.items()})
+
+            # Only the shards of the changed users are written
+            for uid in set(removed) | set(the_data):
+                save("user_ids", uid)
+        elif the_type == "user_ids":
+            reset_user_ids({uid: load_status(status) for uid, status in the_data.items()})
+            save("user_ids")
+        else:
+            if the_type == "reports":
+                the_data = ReportStore(the_data)
+            elif the_type == "watch_ids":
+                the_data = {key: ExpiringMap(value) for key, value in the_data.items()}
+
+            exec(f"glovar.{the_type} = the_data")
+            the_type == "admin_ids" and index_admin_ids()
+            save(the_type)
 
         # Send debug message
         text = (f"{lang('project')}{lang('colon')}{general_link(glovar.project_name, glovar.project_link)}\n"
                 f"{lang('admin_project')}{lang('colon')}{mention_id(aid)}\n"
                 f"{lang('action')}{lang('colon')}{code(lang('rollback'))}\n"
                 f"{lang('more')}{lang('colon')}{code(the_type)}\n")
-        thread(send_message, (client, glovar.debug_channel_id, text))
+        thread(send_message, (client, glovar.debug_channel_id, text), priority="debug")
     except Exception as e:
         logger.warning(f"Receive rollback error: {e}", exc_info=True)
 
@@ -468,24 +526,26 @@ def receive_text_data(message: Message) -> dict:
 
 def receive_user_score(project: str, data: dict) -> bool:
     # Receive and update user's score
-    glovar.locks["message"].acquire()
     try:
         # Basic data
         project = project.lower()
         uid = data["id"]
+        score = data["score"]
 
-        if not init_user_id(uid):
-            return True
+        lock = get_user_lock(uid)
+        lock.acquire()
+        try:
+            if not init_user_id(uid):
+                return True
 
-        score = data["score"]
-        glovar.user_ids[uid]["score"][project] = score
-        save("user_ids")
+            glovar.user_ids[uid]["score"][project] = score
+            save_user(uid)
+        finally:
+            lock.release()
 
         return True
     except Exception as e:
         logger.warning(f"Receive user score error: {e}", exc_info=True)
-    finally:
-        glovar.locks["message"].release()
 
     return False
 
@@ -510,7 +570,7 @@ def receive_watch_user(data: dict) -> bool:
         else:
             return False
 
-        save("watch_ids")
+        save("watch_ids", the_type)
 
         return True
     except Exception as e:
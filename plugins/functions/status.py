@@ -0,0 +1,172 @@
+# SCP-079-WARN - Warn or ban someone by admin commands
+# Copyright (C) 2019 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-WARN.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+from array import array
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+# Enable logging
+logger = logging.getLogger(__name__)
+
+# The projects that share users' scores, the order is the layout of the score vector, only append to it
+projects: Tuple[str, ...] = ("captcha", "clean", "lang", "long", "noflood", "noporn", "nospam", "recheck", "warn")
+
+project_index: Dict[str, int] = {project: i for i, project in enumerate(projects)}
+
+# The keys of a user's status
+status_keys: Tuple[str, ...] = ("ban", "kick", "score", "warn")
+
+
+class UserScore:
+    # The scores of a user, stored in a vector indexed by project
+
+    __slots__ = ("data",)
+
+    def __init__(self, data: Optional[Dict[str, float]] = None):
+        self.data = array("d", bytes(8 * len(projects)))
+
+        for project, score in (data or {}).items():
+            if project in project_index:
+                self[project] = score
+
+    def __contains__(self, project: str) -> bool:
+        return project in project_index
+
+    def __getitem__(self, project: str) -> float:
+        return self.data[project_index[project]]
+
+    def __getstate__(self) -> bytes:
+        return self.data.tobytes()
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(projects)
+
+    def __setitem__(self, project: str, score: float) -> None:
+        self.data[project_index[project]] = score
+
+    def __setstate__(self, state: bytes) -> None:
+        self.data = array("d", bytes(8 * len(projects)))
+        self.data[:len(state) // 8] = array("d", state)
+
+    def copy(self) -> "UserScore":
+        score = UserScore.__new__(UserScore)
+        score.data = self.data[:]
+
+        return score
+
+    def get(self, project: str, default: float = 0.0) -> float:
+        if project not in project_index:
+            return default
+
+        return self[project]
+
+    def items(self) -> List[Tuple[str, float]]:
+        return list(zip(projects, self.data))
+
+    def keys(self) -> Tuple[str, ...]:
+        return projects
+
+    def values(self) -> List[float]:
+        return list(self.data)
+
+
+class UserStatus:
+    # The status of a user, the sets and the dict are only created by status[key] for the changes,
+    # read them with status.get(key, ()) so the reads allocate nothing
+
+    # The cache of the sqlite mode holds weak references to the evicted records
+    __slots__ = status_keys + ("__weakref__",)
+
+    def __init__(self):
+        self.ban: Optional[Set[int]] = None
+        self.kick: Optional[Set[int]] = None
+        self.score: UserScore = UserScore()
+        self.warn: Optional[Dict[int, int]] = None
+
+    def __contains__(self, key: str) -> bool:
+        return key in status_keys
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in status_keys:
+            raise KeyError(key)
+
+        value = getattr(self, key)
+
+        if value is None:
+            value = {} if key == "warn" else set()
+            setattr(self, key, value)
+
+        return value
+
+    def __getstate__(self) -> tuple:
+        return self.ban or None, self.kick or None, self.score, self.warn or None
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key not in status_keys:
+            raise KeyError(key)
+
+        if key == "score" and not isinstance(value, UserScore):
+            value = UserScore(value)
+
+        setattr(self, key, value or None)
+
+    def __setstate__(self, state: tuple) -> None:
+        # The older records also have the waiting status
+        if len(state) == 5:
+            state = state[:3] + state[4:]
+
+        self.ban, self.kick, self.score, self.warn = state
+
+    def copy(self) -> "UserStatus":
+        # Copy the sets and the dict too, each of them is copied in one step
+        status = UserStatus.__new__(UserStatus)
+        status.ban = self.ban.copy() if self.ban else None
+        status.kick = self.kick.copy() if self.kick else None
+        status.score = self.score.copy()
+        status.warn = self.warn.copy() if self.warn else None
+
+        return status
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "UserStatus":
+        # Get the compact record from a legacy dict record
+        status = cls()
+
+        for key in status_keys:
+            if data.get(key):
+                status[key] = data[key]
+
+        return status
+
+    def get(self, key: str, default: Any = None) -> Any:
+        # Get a value without creating the empty set or dict
+        if key not in status_keys or getattr(self, key) is None:
+            return default
+
+        return getattr(self, key)
+
+
+def load_status(data: Any) -> Any:
+    # Migrate a legacy dict record of user_ids, keep the others
+    try:
+        if isinstance(data, dict):
+            return UserStatus.from_dict(data)
+    except Exception as e:
+        logger.warning(f"Load status error: {e}", exc_info=True)
+
+    return data
@@ -0,0 +1,271 @@
+# SCP-079-WARN - Warn or ban someone by admin commands
+# Copyright (C) 2019 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-WARN.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+from heapq import heapify, heappop, heappush
+from sys import getsizeof
+from threading import Lock
+from time import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+# Enable logging
+logger = logging.getLogger(__name__)
+
+
+class ExpiringMap(dict):
+    # A dict of keys to their expiry times, the expired items are evicted in the order of a min-heap
+
+    def __init__(self, data: Optional[Dict[Any, float]] = None):
+        super().__init__(data or {})
+        self.heap: List[Tuple[float, Any]] = [(until, key) for key, until in self.items()]
+        self.lock = Lock()
+        heapify(self.heap)
+
+    def __reduce__(self):
+        # Only pickle the live items
+        self.expire()
+        return self.__class__, (dict(self),)
+
+    def __setitem__(self, key: Any, until: float) -> None:
+        self.lock.acquire()
+        try:
+            super().__setitem__(key, until)
+            heappush(self.heap, (until, key))
+        finally:
+            self.lock.release()
+
+        self.expire()
+
+    def expire(self, now: Optional[float] = None) -> int:
+        # Evict the expired items, return the count of them
+        count = 0
+        now = time() if now is None else now
+        self.lock.acquire()
+        try:
+            while self.heap and self.heap[0][0] <= now:
+                until, key = heappop(self.heap)
+
+                # The key may have been removed or given a new expiry time
+                if self.get(key) != until:
+                    continue
+
+                super().__delitem__(key)
+                count += 1
+
+            # Drop the entries left by the removed and the updated keys
+            if len(self.heap) > 2 * len(self) + 64:
+                self.heap = [(until, key) for key, until in self.items()]
+                heapify(self.heap)
+        except Exception as e:
+            logger.warning(f"Expire error: {e}", exc_info=True)
+        finally:
+            self.lock.release()
+
+        return count
+
+    def update(self, data: Dict[Any, float] = None, **kwargs: float) -> None:
+        for key, until in dict(data or {}, **kwargs).items():
+            self[key] = until
+
+
+class ReportStore(dict):
+    # A dict of report keys to the report records, indexed by the time of the records in a min-heap
+
+    def __init__(self, data: Optional[Dict[str, dict]] = None):
+        super().__init__(data or {})
+        self.heap: List[Tuple[int, str]] = [(record["time"], key) for key, record in self.items()]
+        self.lock = Lock()
+        heapify(self.heap)
+
+    def __reduce__(self):
+        return self.__class__, (dict(self),)
+
+    def __setitem__(self, key: str, record: dict) -> None:
+        self.lock.acquire()
+        try:
+            super().__setitem__(key, record)
+            heappush(self.heap, (record["time"], key))
+        finally:
+            self.lock.release()
+
+    def expire(self, before: int) -> Dict[str, dict]:
+        # Remove the records created before the time, the answered records go with them, return the removed ones
+        result = {}
+        self.lock.acquire()
+        try:
+            while self.heap and self.heap[0][0] < before:
+                the_time, key = heappop(self.heap)
+                record = self.get(key)
+
+                # The key may have been removed or given a new record
+                if not record or record["time"] not in {0, the_time}:
+                    continue
+
+                super().__delitem__(key)
+                result[key] = record
+
+            # Drop the entries left by the removed keys
+            if len(self.heap) > 2 * len(self) + 64:
+                self.heap = [(record["time"], key) for key, record in self.items()]
+                heapify(self.heap)
+        except Exception as e:
+            logger.warning(f"Expire error: {e}", exc_info=True)
+        finally:
+            self.lock.release()
+
+        return result
+
+    def update(self, data: Dict[str, dict] = None, **kwargs: dict) -> None:
+        for key, record in dict(data or {}, **kwargs).items():
+            self[key] = record
+
+
+class RotatingSet:
+    # A set that keeps the items of the current and the previous generation,
+    # a new generation starts when the current one is older than the window or holds the limit of items
+
+    __slots__ = ("current", "limit", "lock", "previous", "start", "window")
+
+    def __init__(self, window: float, limit: int):
+        self.current: Set[Any] = set()
+        self.limit = limit
+        self.lock = Lock()
+        self.previous: Set[Any] = set()
+        self.start = time()
+        self.window = window
+
+    def __contains__(self, item: Any) -> bool:
+        self.lock.acquire()
+        try:
+            self.rotate_locked()
+            return item in self.current or item in self.previous
+        finally:
+            self.lock.release()
+
+    def __len__(self) -> int:
+        return len(self.current) + len(self.previous)
+
+    def add(self, item: Any) -> None:
+        self.lock.acquire()
+        try:
+            self.rotate_locked()
+            self.current.add(item)
+            len(self.current) >= self.limit and self.rotate_locked(True)
+        finally:
+            self.lock.release()
+
+    def rotate(self) -> bool:
+        # Start a new generation if it is due, return whether it started
+        self.lock.acquire()
+        try:
+            return self.rotate_locked()
+        finally:
+            self.lock.release()
+
+    def rotate_locked(self, force: bool = False) -> bool:
+        # Start a new generation if it is due or forced, the caller holds the lock
+        now = time()
+
+        if now - self.start >= 2 * self.window:
+            self.previous, self.current = set(), set()
+        elif force or now - self.start >= self.window:
+            self.previous, self.current = self.current, set()
+        else:
+            return False
+
+        self.start = now
+
+        return True
+
+    def size(self) -> int:
+        # Get the memory used by the items
+        return getsizeof(self.current) + getsizeof(self.previous)
+
+
+class ShardedMap(dict):
+    # A dict of ids to values, the ids of each shard (id % shards) are indexed to save the shard alone
+
+    def __init__(self, shards: int, data: Optional[Dict[int, Any]] = None):
+        super().__init__()
+        self.index: List[Set[int]] = [set() for _ in range(shards)]
+        self.lock = Lock()
+        self.shards = shards
+        self.update(data)
+
+    def __delitem__(self, key: int) -> None:
+        self.lock.acquire()
+        try:
+            super().__delitem__(key)
+            self.index[key % self.shards].discard(key)
+        finally:
+            self.lock.release()
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+    def __setitem__(self, key: int, value: Any) -> None:
+        self.lock.acquire()
+        try:
+            super().__setitem__(key, value)
+            self.index[key % self.shards].add(key)
+        finally:
+            self.lock.release()
+
+    def clear(self) -> None:
+        self.lock.acquire()
+        try:
+            super().clear()
+
+            for keys in self.index:
+                keys.clear()
+        finally:
+            self.lock.release()
+
+    def get_shard(self, i: int) -> Dict[int, Any]:
+        # Get the items of a shard, the cost is the size of the shard
+        result = {}
+        self.lock.acquire()
+        try:
+            for key in self.index[i]:
+                result[key] = super().__getitem__(key)
+        finally:
+            self.lock.release()
+
+        return result
+
+    def pop(self, key: int, *args: Any) -> Any:
+        self.lock.acquire()
+        try:
+            value = super().pop(key, *args)
+            self.index[key % self.shards].discard(key)
+        finally:
+            self.lock.release()
+
+        return value
+
+    def shard_keys(self, i: int) -> List[int]:
+        # Get the ids of a shard
+        self.lock.acquire()
+        try:
+            return list(self.index[i])
+        finally:
+            self.lock.release()
+
+    def update(self, data: Dict[int, Any] = None, **kwargs: Any) -> None:
+        for key, value in dict(data or {}, **kwargs).items():
+            self[key] = value
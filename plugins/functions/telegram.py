@@ -26,7 +26,8 @@ from pyrogram.errors import ChatAdminRequired, ButtonDataInvalid, ChannelInvalid
 from pyrogram.errors import MessageDeleteForbidden, PeerIdInvalid, QueryIdInvalid, UsernameInvalid, UsernameNotOccupied
 
 from .. import glovar
-from .etc import delay, get_int, t2t, wait_flood
+from .etc import delay, get_int, t2t
+from .rate import take_token, wait_flood
 
 # Enable logging
 logger = logging.getLogger(__name__)
@@ -40,6 +41,7 @@ def answer_callback(client: Client, callback_query_id: str, text: str, show_aler
         while flood_wait:
             flood_wait = False
             try:
+                take_token("answer_callback_query")
                 result = client.answer_callback_query(
                     callback_query_id=callback_query_id,
                     text=text,
@@ -47,7 +49,7 @@ def answer_callback(client: Client, callback_query_id: str, text: str, show_aler
                 )
             except FloodWait as e:
                 flood_wait = True
-                wait_flood(e)
+                wait_flood(e, "answer_callback_query")
             except QueryIdInvalid:
                 return False
     except Exception as e:
@@ -68,10 +70,11 @@ def delete_messages(client: Client, cid: int, mids: Iterable[int]) -> Optional[b
                 while flood_wait:
                     flood_wait = False
                     try:
+                        take_token("delete_messages", cid)
                         result = client.delete_messages(chat_id=cid, message_ids=mids)
                     except FloodWait as e:
                         flood_wait = True
-                        wait_flood(e)
+                        wait_flood(e, "delete_messages", cid)
             except MessageDeleteForbidden:
                 return False
             except Exception as e:
@@ -90,10 +93,11 @@ def download_media(client: Client, file_id: str, file_ref: str, file_path: str)
         while flood_wait:
             flood_wait = False
             try:
+                take_token("download_media")
                 result = client.download_media(message=file_id, file_ref=file_ref, file_name=file_path)
             except FloodWait as e:
                 flood_wait = True
-                wait_flood(e)
+                wait_flood(e, "download_media")
     except Exception as e:
         logger.warning(f"Download media {file_id} to {file_path} error: {e}", exc_info=True)
 
@@ -112,6 +116,7 @@ def edit_message_text(client: Client, cid: int, mid: int, text: str,
         while flood_wait:
             flood_wait = False
             try:
+                take_token("edit_message_text", cid)
                 result = client.edit_message_text(
                     chat_id=cid,
                     message_id=mid,
@@ -122,7 +127,7 @@ def edit_message_text(client: Client, cid: int, mid: int, text: str,
                 )
             except FloodWait as e:
                 flood_wait = True
-                wait_flood(e)
+                wait_flood(e, "edit_message_text", cid)
             except ButtonDataInvalid:
                 logger.warning(f"Edit message {mid} text in {cid} - invalid markup: {markup}")
             except (ChatAdminRequired, PeerIdInvalid, ChannelInvalid, ChannelPrivate):
@@ -141,10 +146,11 @@ def get_admins(client: Client, cid: int) -> Union[bool, List[ChatMember], None]:
         while flood_wait:
             flood_wait = False
             try:
+                take_token("get_chat_members", cid)
                 result = client.get_chat_members(chat_id=cid, filter="administrators")
             except FloodWait as e:
                 flood_wait = True
-                wait_flood(e)
+                wait_flood(e, "get_chat_members", cid)
             except (PeerIdInvalid, ChannelInvalid, ChannelPrivate):
                 return False
     except Exception as e:
@@ -161,10 +167,11 @@ def get_chat(client: Client, cid: Union[int, str]) -> Union[Chat, ChatPreview, N
         while flood_wait:
             flood_wait = False
             try:
+                take_token("get_chat", cid)
                 result = client.get_chat(chat_id=cid)
             except FloodWait as e:
                 flood_wait = True
-                wait_flood(e)
+                wait_flood(e, "get_chat", cid)
             except (PeerIdInvalid, ChannelInvalid, ChannelPrivate):
                 return None
     except Exception as e:
@@ -212,10 +219,11 @@ def get_messages(client: Client, cid: int, mids: Iterable[int]) -> Optional[List
         while flood_wait:
             flood_wait = False
             try:
+                take_token("get_messages", cid)
                 result = client.get_messages(chat_id=cid, message_ids=mids)
             except FloodWait as e:
                 flood_wait = True
-                wait_flood(e)
+                wait_flood(e, "get_messages", cid)
     except Exception as e:
         logger.warning(f"Get messages {mids} in {cid} error: {e}", exc_info=True)
 
@@ -234,12 +242,13 @@ def get_user_bio(client: Client, uid: int, normal: bool = False, printable: bool
         while flood_wait:
             flood_wait = False
             try:
+                take_token("get_full_user")
                 user: UserFull = client.send(GetFullUser(id=user_id))
                 if user and user.about:
                     result = t2t(user.about, normal, printable)
             except FloodWait as e:
                 flood_wait = True
-                wait_flood(e)
+                wait_flood(e, "get_full_user")
     except Exception as e:
         logger.warning(f"Get user {uid} bio error: {e}", exc_info=True)
 
@@ -254,10 +263,11 @@ def kick_chat_member(client: Client, cid: int, uid: Union[int, str]) -> Union[bo
         while flood_wait:
             flood_wait = False
             try:
+                take_token("kick_chat_member", cid)
                 result = client.kick_chat_member(chat_id=cid, user_id=uid)
             except FloodWait as e:
                 flood_wait = True
-                wait_flood(e)
+                wait_flood(e, "kick_chat_member", cid)
     except Exception as e:
         logger.warning(f"Kick chat member {uid} in {cid} error: {e}", exc_info=True)
 
@@ -271,10 +281,11 @@ def leave_chat(client: Client, cid: int, delete: bool = False) -> bool:
         while flood_wait:
             flood_wait = False
             try:
+                take_token("leave_chat", cid)
                 client.leave_chat(chat_id=cid, delete=delete)
             except FloodWait as e:
                 flood_wait = True
-                wait_flood(e)
+                wait_flood(e, "leave_chat", cid)
             except (PeerIdInvalid, ChannelInvalid, ChannelPrivate):
                 return False
 
@@ -293,10 +304,11 @@ def resolve_peer(client: Client, pid: Union[int, str]) -> Union[bool, InputPeerC
         while flood_wait:
             flood_wait = False
             try:
+                take_token("resolve_peer")
                 result = client.resolve_peer(pid)
             except FloodWait as e:
                 flood_wait = True
-                wait_flood(e)
+                wait_flood(e, "resolve_peer")
             except (PeerIdInvalid, UsernameInvalid, UsernameNotOccupied):
                 return False
     except Exception as e:
@@ -347,6 +359,7 @@ def send_document(client: Client, cid: int, document: str, file_ref: str = None,
         while flood_wait:
             flood_wait = False
             try:
+                take_token("send_document", cid)
                 result = client.send_document(
                     chat_id=cid,
                     document=document,
@@ -358,7 +371,7 @@ def send_document(client: Client, cid: int, document: str, file_ref: str = None,
                 )
             except FloodWait as e:
                 flood_wait = True
-                wait_flood(e)
+                wait_flood(e, "send_document", cid)
             except ButtonDataInvalid:
                 logger.warning(f"Send document {document} to {cid} - invalid markup: {markup}")
             except (ChatAdminRequired, PeerIdInvalid, ChannelInvalid, ChannelPrivate):
@@ -381,6 +394,7 @@ def send_message(client: Client, cid: int, text: str, mid: int = None,
         while flood_wait:
             flood_wait = False
             try:
+                take_token("send_message", cid)
                 result = client.send_message(
                     chat_id=cid,
                     text=text,
@@ -391,7 +405,7 @@ def send_message(client: Client, cid: int, text: str, mid: int = None,
                 )
             except FloodWait as e:
                 flood_wait = True
-                wait_flood(e)
+                wait_flood(e, "send_message", cid)
             except ButtonDataInvalid:
                 logger.warning(f"Send message to {cid} - invalid markup: {markup}")
             except (ChatAdminRequired, PeerIdInvalid, ChannelInvalid, ChannelPrivate):
@@ -414,6 +428,7 @@ def send_report_message(secs: int, client: Client, cid: int, text: str, mid: int
         while flood_wait:
             flood_wait = False
             try:
+                take_token("send_message", cid)
                 result = client.send_message(
                     chat_id=cid,
                     text=text,
@@ -424,7 +439,7 @@ def send_report_message(secs: int, client: Client, cid: int, text: str, mid: int
                 )
             except FloodWait as e:
                 flood_wait = True
-                wait_flood(e)
+                wait_flood(e, "send_message", cid)
             except ButtonDataInvalid:
                 logger.warning(f"Send report message to {cid} - invalid markup: {markup}")
 
@@ -433,7 +448,7 @@ def send_report_message(secs: int, client: Client, cid: int, text: str, mid: int
 
         mid = result.message_id
         mids = [mid]
-        delay(secs, delete_messages, [client, cid, mids])
+        delay(secs, delete_messages, [client, cid, mids], f"delete_{cid}_{mid}")
     except Exception as e:
         logger.warning(f"Send report message to {cid} error: {e}", exc_info=True)
 
@@ -448,10 +463,11 @@ def unban_chat_member(client: Client, cid: int, uid: Union[int, str]) -> Optiona
         while flood_wait:
             flood_wait = False
             try:
+                take_token("unban_chat_member", cid)
                 result = client.unban_chat_member(chat_id=cid, user_id=uid)
             except FloodWait as e:
                 flood_wait = True
-                wait_flood(e)
+                wait_flood(e, "unban_chat_member", cid)
     except Exception as e:
         logger.warning(f"Unban chat member {uid} in {cid} error: {e}", exc_info=True)
 
@@ -24,8 +24,13 @@ from pyrogram import Client
 from .. import glovar
 from .channel import share_data
 from .etc import code, general_link, get_now, lang, thread
-from .file import data_to_file, save
+from .database import dump_rows
+from .file import data_to_file, delete_file, get_new_path, save, save_thread
 from .group import delete_message, leave_group
+from .ids import reset_user_ids, set_admin_ids
+from .lock import get_group_lock
+from .rate import prune_buckets
+from .structures import ExpiringMap, ReportStore
 from .telegram import get_admins, get_group_info, send_message
 
 # Enable logging
@@ -36,10 +41,46 @@ def backup_files(client: Client) -> bool:
     # Backup data files to BACKUP
     try:
         for file in glovar.file_list:
+            # Only ship the shards changed since the last backup
+            if file == "user_ids" and glovar.sharded:
+                glovar.locks["save"].acquire()
+                shards, glovar.shard_backup = glovar.shard_backup, 0
+                glovar.locks["save"].release()
+
+                for i in range(glovar.shards):
+                    if not shards & (1 << i):
+                        continue
+
+                    share_data(
+                        client=client,
+                        receivers=["BACKUP"],
+                        action="backup",
+                        action_type="data",
+                        data=f"{file}.{i}",
+                        file=f"data/{file}.{i}"
+                    )
+                    sleep(5)
+
+                continue
+
+            # Stream the table to a file in sqlite mode
+            if glovar.sqlite and file in glovar.sqlite_list:
+                file_path = get_new_path()
+
+                with open(file_path, "wb") as f:
+                    count = dump_rows(glovar.database, file, f)
+
+                if not count:
+                    delete_file(file_path)
+                    continue
+
             # Check
-            if not eval(f"glovar.{file}"):
+            elif not eval(f"glovar.{file}"):
                 continue
 
+            else:
+                file_path = f"data/{file}"
+
             # Share
             share_data(
                 client=client,
@@ -47,7 +88,7 @@ def backup_files(client: Client) -> bool:
                 action="backup",
                 action_type="data",
                 data=file,
-                file=f"data/{file}"
+                file=file_path
             )
             sleep(5)
 
@@ -58,57 +99,92 @@ def backup_files(client: Client) -> bool:
     return False
 
 
+def expire_reports(client: Client) -> bool:
+    # Clear the reports older than a day
+    try:
+        report_list = glovar.reports.expire(get_now() - 86400)
+
+        if not report_list:
+            return True
+
+        for key, report_record in report_list.items():
+            save("reports", key)
+
+            if not report_record["time"]:
+                continue
+
+            gid = report_record["group_id"]
+            mid = report_record["report_id"]
+            thread(delete_message, (client, gid, mid))
+
+        return True
+    except Exception as e:
+        logger.warning(f"Expire reports error: {e}", exc_info=True)
+
+    return False
+
+
 def interval_hour_01(client: Client) -> bool:
     # Execute every hour
-    glovar.locks["message"].acquire()
     try:
         # Clear old calling messages
         now = get_now()
         for gid in list(glovar.message_ids):
-            mid, time = glovar.message_ids[gid]
+            lock = get_group_lock(gid)
+            lock.acquire()
+            try:
+                mid, time = glovar.message_ids.get(gid, (0, 0))
 
-            if not time:
-                continue
+                if not time:
+                    continue
 
-            if now - time < 86400:
-                continue
+                if now - time < 86400:
+                    continue
+
+                glovar.message_ids[gid] = (0, 0)
+            finally:
+                lock.release()
 
-            glovar.message_ids[gid] = (0, 0)
             delete_message(client, gid, mid)
 
         save("message_ids")
 
-        # Clear old reports
-        now = get_now()
-        for key in list(glovar.reports):
-            report_record = glovar.reports[key]
-            time = report_record["time"]
+        # Clear users' waiting status
+        glovar.waiting_ids = set()
 
-            if not time:
-                glovar.reports.pop(key, {})
-                continue
+        return True
+    except Exception as e:
+        logger.warning(f"Interval hour 01 error: {e}", exc_info=True)
 
-            if now - time < 86400:
-                continue
+    return False
 
-            gid = report_record["group_id"]
-            mid = report_record["report_id"]
-            thread(delete_message, (client, gid, mid))
-            glovar.reports.pop(key, {})
 
-        save("reports")
+def interval_min_10() -> bool:
+    # Execute every 10 minutes
+    try:
+        # Compact the journal of user_ids
+        if glovar.journal and glovar.journal_count:
+            save_thread("user_ids")
 
-        # Clear user's waiting status
-        for uid in list(glovar.user_ids):
-            glovar.user_ids[uid]["waiting"] = set()
+        # Forget the idle chats
+        prune_buckets()
 
-        save("user_ids")
+        # Evict the expired watches
+        for the_type in list(glovar.watch_ids):
+            glovar.watch_ids[the_type].expire()
+
+        # Forget the old declared messages, record the memory they use
+        declared_list = list(glovar.declared_message_ids.values())
+
+        for declared in declared_list:
+            declared.rotate()
+
+        glovar.metrics["declared_count"] = sum(len(declared) for declared in declared_list)
+        glovar.metrics["declared_size"] = sum(declared.size() for declared in declared_list)
 
         return True
     except Exception as e:
-        logger.warning(f"Interval hour 01 error: {e}", exc_info=True)
-    finally:
-        glovar.locks["message"].release()
+        logger.warning(f"Interval min 10 error: {e}", exc_info=True)
 
     return False
 
@@ -124,22 +200,22 @@ def reset_data(client: Client) -> bool:
         glovar.left_group_ids = set()
         save("left_group_ids")
 
-        glovar.user_ids = {}
+        reset_user_ids()
         save("user_ids")
 
         glovar.watch_ids = {
-            "ban": {},
-            "delete": {}
+            "ban": ExpiringMap(),
+            "delete": ExpiringMap()
         }
         save("watch_ids")
 
-        glovar.reports = {}
+        glovar.reports = ReportStore()
         save("reports")
 
         # Send debug message
         text = (f"{lang('project')}{lang('colon')}{general_link(glovar.project_name, glovar.project_link)}\n"
                 f"{lang('action')}{lang('colon')}{code(lang('reset'))}\n")
-        thread(send_message, (client, glovar.debug_channel_id, text))
+        thread(send_message, (client, glovar.debug_channel_id, text), priority="debug")
 
         return True
     except Exception as e:
@@ -158,9 +234,9 @@ def update_admins(client: Client) -> bool:
             reason = "permissions"
             admin_members = get_admins(client, gid)
             if admin_members and any([admin.user.is_self for admin in admin_members]):
-                glovar.admin_ids[gid] = {admin.user.id for admin in admin_members
-                                         if ((not admin.user.is_bot and not admin.user.is_deleted)
-                                             or admin.user.id in glovar.bot_ids)}
+                set_admin_ids(gid, {admin.user.id for admin in admin_members
+                                    if ((not admin.user.is_bot and not admin.user.is_deleted)
+                                        or admin.user.id in glovar.bot_ids)})
                 if glovar.user_id not in glovar.admin_ids[gid]:
                     reason = "user"
                 else:
@@ -189,9 +265,9 @@ def update_admins(client: Client) -> bool:
                                   f"{lang('group_name')}{lang('colon')}{general_link(group_name, group_link)}\n"
                                   f"{lang('group_id')}{lang('colon')}{code(gid)}\n"
                                   f"{lang('status')}{lang('colon')}{code(reason)}\n")
-                    thread(send_message, (client, glovar.debug_channel_id, debug_text))
+                    thread(send_message, (client, glovar.debug_channel_id, debug_text), priority="debug")
                 else:
-                    save("admin_ids")
+                    save("admin_ids", gid)
             elif admin_members is False or any([admin.user.is_self for admin in admin_members]) is False:
                 # Bot is not in the chat, leave automatically without approve
                 group_name, group_link = get_group_info(client, gid)
@@ -213,7 +289,7 @@ def update_admins(client: Client) -> bool:
                               f"{lang('group_id')}{lang('colon')}{code(gid)}\n"
                               f"{lang('status')}{lang('colon')}{code(lang('leave_auto'))}\n"
                               f"{lang('reason')}{lang('colon')}{code(lang('reason_leave'))}\n")
-                thread(send_message, (client, glovar.debug_channel_id, debug_text))
+                thread(send_message, (client, glovar.debug_channel_id, debug_text), priority="debug")
 
         return True
     except Exception as e:
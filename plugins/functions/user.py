@@ -18,7 +18,6 @@
 
 import logging
 from random import sample
-from time import sleep
 from typing import Union
 
 from pyrogram import Client, InlineKeyboardButton, InlineKeyboardMarkup, Message, User
@@ -27,10 +26,11 @@ from .. import glovar
 from .channel import ask_for_help, forward_evidence, send_debug, update_score
 from .etc import button_data, code, delay, general_link, get_channel_link, get_int, get_now, get_text, lang
 from .etc import mention_id, message_link, random_str, thread
-from .file import save
+from .file import save, save_user
 from .filters import is_class_c, is_from_user, is_limited_admin
 from .group import delete_message
 from .ids import init_user_id
+from .lock import is_locked, try_lock, unlock
 from .telegram import edit_message_text, kick_chat_member, unban_chat_member
 
 # Enable logging
@@ -54,14 +54,15 @@ def ban_user(client: Client, message: Message, uid: int, aid: int, result: int =
         if not init_user_id(uid):
             return "", None
 
-        # Check users' locks
-        if gid in glovar.user_ids[uid]["lock"]:
+        # Take the user's lock
+        token = try_lock(uid, gid)
+
+        if not token:
             return "", None
 
         # Proceed
-        glovar.user_ids[uid]["lock"].add(gid)
         try:
-            if gid in glovar.user_ids[uid]["ban"]:
+            if gid in glovar.user_ids[uid].get("ban", ()):
                 text += (f"{lang('user_id')}{lang('colon')}{mention_id(uid)}\n"
                          f"{lang('action')}{lang('colon')}{code(lang('action_ban'))}\n"
                          f"{lang('status')}{lang('colon')}{code(lang('status_failed'))}\n"
@@ -88,10 +89,10 @@ def ban_user(client: Client, message: Message, uid: int, aid: int, result: int =
             glovar.counts[gid][aid] += 1
 
             # Ban the user
-            thread(kick_chat_member, (client, gid, uid))
+            thread(kick_chat_member, (client, gid, uid), priority="enforce")
             glovar.user_ids[uid]["ban"].add(gid)
-            glovar.user_ids[uid]["warn"].pop(gid, 0)
-            update_score(client, uid)
+            glovar.user_ids[uid].get("warn", {}).pop(gid, 0)
+            update_score(client, uid, True)
 
             # Generate report text
             stored_link = general_link(result.message_id, message_link(result))
@@ -127,7 +128,7 @@ def ban_user(client: Client, message: Message, uid: int, aid: int, result: int =
                 reason=reason
             )
         finally:
-            glovar.user_ids[uid]["lock"].discard(gid)
+            unlock(uid, gid, token)
     except Exception as e:
         logger.warning(f"Ban user error: {e}", exc_info=True)
 
@@ -147,29 +148,30 @@ def forgive_user(client: Client, message: Message, uid: int, reason: str = None)
         if not init_user_id(uid):
             return "", False
 
-        # Check users' locks
-        if gid in glovar.user_ids[uid]["lock"]:
+        # Take the user's lock
+        token = try_lock(uid, gid)
+
+        if not token:
             return "", False
 
         # Proceed
-        glovar.user_ids[uid]["lock"].add(gid)
         try:
             # Text prefix
             text += f"{lang('user_id')}{lang('colon')}{mention_id(uid)}\n"
 
-            if gid in glovar.user_ids[uid]["ban"]:
-                glovar.user_ids[uid]["ban"].discard(gid)
+            if gid in glovar.user_ids[uid].get("ban", ()):
+                glovar.user_ids[uid].get("ban", set()).discard(gid)
                 thread(unban_chat_member, (client, gid, uid))
                 text += (f"{lang('action')}{lang('colon')}{code(lang('action_unban'))}\n"
                          f"{lang('status')}{lang('colon')}{code(lang('status_succeeded'))}\n")
                 success = True
-            elif glovar.user_ids[uid]["warn"].get(gid, 0):
-                glovar.user_ids[uid]["warn"].pop(gid, 0)
+            elif glovar.user_ids[uid].get("warn", {}).get(gid, 0):
+                glovar.user_ids[uid].get("warn", {}).pop(gid, 0)
                 text += (f"{lang('action')}{lang('colon')}{code(lang('action_unwarns'))}\n"
                          f"{lang('status')}{lang('colon')}{code(lang('status_succeeded'))}\n")
                 success = True
-            elif gid in glovar.user_ids[uid]["waiting"]:
-                glovar.user_ids[uid]["waiting"].discard(gid)
+            elif (uid, gid) in glovar.waiting_ids:
+                glovar.waiting_ids.discard((uid, gid))
                 text += (f"{lang('action')}{lang('colon')}{code(lang('action_unwait'))}\n"
                          f"{lang('status')}{lang('colon')}{code(lang('status_succeeded'))}\n")
                 success = True
@@ -184,7 +186,7 @@ def forgive_user(client: Client, message: Message, uid: int, reason: str = None)
             if not success:
                 return text, success
 
-            save("user_ids")
+            save_user(uid)
 
             if reason:
                 text += f"{lang('reason')}{lang('colon')}{code(reason)}\n"
@@ -199,7 +201,7 @@ def forgive_user(client: Client, message: Message, uid: int, reason: str = None)
                 reason=reason
             )
         finally:
-            glovar.user_ids[uid]["lock"].discard(gid)
+            unlock(uid, gid, token)
     except Exception as e:
         logger.warning(f"Forgive user error: {e}")
 
@@ -256,7 +258,7 @@ def get_class_d_id(message: Message) -> (int, int):
 def kick_user(client: Client, gid: int, uid: Union[int, str]) -> bool:
     # Kick a user
     try:
-        thread(kick_user_thread, (client, gid, uid))
+        thread(kick_user_thread, (client, gid, uid), priority="enforce")
 
         return True
     except Exception as e:
@@ -269,8 +271,7 @@ def kick_user_thread(client: Client, gid: int, uid: Union[int, str]) -> bool:
     # Kick a user thread
     try:
         kick_chat_member(client, gid, uid)
-        sleep(3)
-        unban_chat_member(client, gid, uid)
+        delay(3, unban_chat_member, [client, gid, uid], priority="enforce")
 
         return True
     except Exception as e:
@@ -296,7 +297,7 @@ def mention_answer(client: Client, message: Message, aid: int, uid: int, action_
 
             # Edit the report message
             thread(edit_message_text, (client, gid, mid, text, markup))
-            delay(180, delete_message, [client, gid, mid])
+            delay(180, delete_message, [client, gid, mid], f"delete_{gid}_{mid}")
 
         # Delete
         elif action_type == "delete":
@@ -326,15 +327,16 @@ def remove_user(client: Client, message: Message, uid: int, aid: int,
         if not init_user_id(uid):
             return "", False
 
-        # Check users' locks
-        if gid in glovar.user_ids[uid]["lock"]:
+        # Take the user's lock
+        token = try_lock(uid, gid)
+
+        if not token:
             return "", False
 
         # Proceed
-        glovar.user_ids[uid]["lock"].add(gid)
         try:
             # Check ban status
-            if gid in glovar.user_ids[uid]["ban"]:
+            if gid in glovar.user_ids[uid].get("ban", ()):
                 text += (f"{lang('user_id')}{lang('colon')}{mention_id(uid)}\n"
                          f"{lang('action')}{lang('colon')}{code(lang('action_kick'))}\n"
                          f"{lang('status')}{lang('colon')}{code(lang('status_failed'))}\n"
@@ -364,7 +366,7 @@ def remove_user(client: Client, message: Message, uid: int, aid: int,
             # Kick the user
             kick_user(client, gid, uid)
             glovar.user_ids[uid]["kick"].add(gid)
-            update_score(client, uid)
+            update_score(client, uid, True)
 
             # Generate report text
             stored_link = general_link(result.message_id, message_link(result))
@@ -390,7 +392,7 @@ def remove_user(client: Client, message: Message, uid: int, aid: int,
                 reason=reason
             )
         finally:
-            glovar.user_ids[uid]["lock"].discard(gid)
+            unlock(uid, gid, token)
     except Exception as e:
         logger.warning(f"Remove user error: {e}", exc_info=True)
 
@@ -410,9 +412,8 @@ def report_answer(client: Client, message: Message, gid: int, aid: int, mid: int
                     f"{lang('status')}{lang('colon')}{code(lang('status_failed'))}\n"
                     f"{lang('reason')}{lang('colon')}{code(lang('expired'))}\n")
             thread(edit_message_text, (client, gid, mid, text))
-            delay(15, delete_message, [client, gid, mid])
-            glovar.user_ids[uid]["waiting"].discard(gid)
-            save("user_ids")
+            delay(15, delete_message, [client, gid, mid], f"delete_{gid}_{mid}")
+            glovar.waiting_ids.discard((uid, gid))
             return ""
 
         if not report_record["time"]:
@@ -430,7 +431,7 @@ def report_answer(client: Client, message: Message, gid: int, aid: int, mid: int
             return ""
 
         # Check users' locks
-        if gid in glovar.user_ids[uid]["lock"] or gid in glovar.user_ids[rid]["lock"]:
+        if is_locked(uid, gid) or is_locked(rid, gid):
             return lang("answer_proceeded")
 
         # Lock the report status
@@ -472,13 +473,10 @@ def report_answer(client: Client, message: Message, gid: int, aid: int, mid: int
                 secs = 15
 
             thread(edit_message_text, (client, gid, mid, text, markup))
-            delay(secs, delete_message, [client, gid, mid])
+            delay(secs, delete_message, [client, gid, mid], f"delete_{gid}_{mid}")
         finally:
-            glovar.user_ids[uid]["lock"].discard(gid)
-            glovar.user_ids[rid]["lock"].discard(gid)
-            glovar.user_ids[uid]["waiting"].discard(gid)
-            glovar.user_ids[rid]["waiting"].discard(gid)
-            save("user_ids")
+            glovar.waiting_ids.discard((uid, gid))
+            glovar.waiting_ids.discard((rid, gid))
     except Exception as e:
         logger.warning(f"Report answer error: {e}", exc_info=True)
 
@@ -497,9 +495,8 @@ def report_user(gid: int, user: User, rid: int, mid: int,
         else:
             return "", None
 
-        glovar.user_ids[uid]["waiting"].add(gid)
-        glovar.user_ids[rid]["waiting"].add(gid)
-        save("user_ids")
+        glovar.waiting_ids.add((uid, gid))
+        glovar.waiting_ids.add((rid, gid))
 
         key = random_str(8)
 
@@ -585,15 +582,16 @@ def warn_user(client: Client, message: Message, uid: int, aid: int,
         if not init_user_id(uid):
             return "", None
 
-        # Check users' locks
-        if gid in glovar.user_ids[uid]["lock"]:
+        # Take the user's lock
+        token = try_lock(uid, gid)
+
+        if not token:
             return "", None
 
         # Proceed
-        glovar.user_ids[uid]["lock"].add(gid)
         try:
             # Check ban status
-            if gid in glovar.user_ids[uid]["ban"]:
+            if gid in glovar.user_ids[uid].get("ban", ()):
                 text += (f"{lang('user_id')}{lang('colon')}{mention_id(uid)}\n"
                          f"{lang('action')}{lang('colon')}{code(lang('action_warn'))}\n"
                          f"{lang('status')}{lang('colon')}{code(lang('status_failed'))}\n"
@@ -618,11 +616,12 @@ def warn_user(client: Client, message: Message, uid: int, aid: int,
                 return text, None
 
             # Add warn count
-            if not glovar.user_ids[uid]["warn"].get(gid, 0):
+            if not glovar.user_ids[uid].get("warn", {}).get(gid, 0):
                 glovar.user_ids[uid]["warn"][gid] = 1
                 update_score(client, uid)
             else:
                 glovar.user_ids[uid]["warn"][gid] += 1
+                save_user(uid)
 
             # Read count and group config
             warn_count = glovar.user_ids[uid]["warn"][gid]
@@ -630,7 +629,7 @@ def warn_user(client: Client, message: Message, uid: int, aid: int,
 
             # Warn or ban
             if warn_count >= limit:
-                glovar.user_ids[uid]["lock"].discard(gid)
+                unlock(uid, gid, token)
                 text = (f"{lang('user_banned')}{lang('colon')}{mention_id(uid)}\n"
                         f"{lang('ban_reason')}{lang('colon')}{code(lang('reason_limit'))}\n")
                 _, markup = ban_user(client, message, uid, aid, result, reason)
@@ -667,7 +666,7 @@ def warn_user(client: Client, message: Message, uid: int, aid: int,
             if markup and reason:
                 text += f"{lang('reason')}{lang('colon')}{code(reason)}\n"
         finally:
-            glovar.user_ids[uid]["lock"].discard(gid)
+            unlock(uid, gid, token)
     except Exception as e:
         logger.warning(f"Warn user error: {e}", exc_info=True)
 
@@ -682,7 +681,7 @@ def unban_user(client: Client, message: Message, uid: int, aid: int) -> str:
         gid = message.chat.id
 
         # Check ban status
-        if gid not in glovar.user_ids[uid]["ban"]:
+        if gid not in glovar.user_ids[uid].get("ban", ()):
             text = (f"{lang('user_id')}{lang('colon')}{mention_id(uid)}\n"
                     f"{lang('action')}{lang('colon')}{code(lang('action_unban'))}\n"
                     f"{lang('status')}{lang('colon')}{code(lang('status_failed'))}\n"
@@ -692,7 +691,7 @@ def unban_user(client: Client, message: Message, uid: int, aid: int) -> str:
 
         # Proceed
         unban_chat_member(client, gid, uid)
-        glovar.user_ids[uid]["ban"].discard(gid)
+        glovar.user_ids[uid].get("ban", set()).discard(gid)
         update_score(client, uid)
         text = (f"{lang('user_unbanned')}{lang('colon')}{code(uid)}\n"
                 f"{lang('description')}{lang('colon')}{code(lang('description_by_admin'))}\n")
@@ -719,12 +718,13 @@ def undo_user(client: Client, message: Message, aid: int, uid: int, action_type:
         if not init_user_id(uid):
             return ""
 
-        # Check the user's lock
-        if gid in glovar.user_ids[uid]["lock"]:
+        # Take the user's lock
+        token = try_lock(uid, gid)
+
+        if not token:
             return lang("answer_proceeded")
 
         # Proceed
-        glovar.user_ids[uid]["lock"].add(gid)
         try:
             if action_type == "ban":
                 text = unban_user(client, message, uid, aid)
@@ -733,10 +733,10 @@ def undo_user(client: Client, message: Message, aid: int, uid: int, action_type:
 
             thread(edit_message_text, (client, gid, mid, text))
         finally:
-            glovar.user_ids[uid]["lock"].discard(gid)
+            unlock(uid, gid, token)
 
         # Save data
-        save("user_ids")
+        save_user(uid)
     except Exception as e:
         logger.warning(f"Undo user error: {e}", exc_info=True)
 
@@ -751,7 +751,7 @@ def unwarn_user(client: Client, message: Message, uid: int, aid: int) -> str:
         gid = message.chat.id
 
         # Check ban status
-        if gid in glovar.user_ids[uid]["ban"]:
+        if gid in glovar.user_ids[uid].get("ban", ()):
             text = (f"{lang('user_id')}{lang('colon')}{mention_id(uid)}\n"
                     f"{lang('action')}{lang('colon')}{code(lang('action_unwarn'))}\n"
                     f"{lang('status')}{lang('colon')}{code(lang('status_failed'))}\n"
@@ -760,7 +760,7 @@ def unwarn_user(client: Client, message: Message, uid: int, aid: int) -> str:
             return text
 
         # Check warnings count
-        if not glovar.user_ids[uid]["warn"].get(gid, 0):
+        if not glovar.user_ids[uid].get("warn", {}).get(gid, 0):
             text = (f"{lang('user_id')}{lang('colon')}{mention_id(uid)}\n"
                     f"{lang('action')}{lang('colon')}{lang('action_unwarn')}\n"
                     f"{lang('status')}{lang('colon')}{code(lang('status_failed'))}\n"
@@ -773,7 +773,7 @@ def unwarn_user(client: Client, message: Message, uid: int, aid: int) -> str:
         warn_count = glovar.user_ids[uid]["warn"][gid]
 
         if warn_count == 0:
-            glovar.user_ids[uid]["warn"].pop(gid, 0)
+            glovar.user_ids[uid].get("warn", {}).pop(gid, 0)
             update_score(client, uid)
             text = (f"{lang('user_unwarned')}{lang('colon')}{mention_id(uid)}\n"
                     f"{lang('user_warns')}{lang('colon')}{code(lang('reason_none'))}\n")
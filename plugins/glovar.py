@@ -19,14 +19,22 @@
 import logging
 import pickle
 from configparser import RawConfigParser
-from os import mkdir
+from glob import glob
+from itertools import count
+from os import fsync, mkdir, remove, rename, replace
 from os.path import exists
+from queue import PriorityQueue, Queue
 from shutil import rmtree
-from threading import Lock
-from typing import Dict, List, Set, Tuple, Union
+from sqlite3 import Connection
+from threading import Condition, Lock, Thread, local
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple, Union
 
 from pyrogram import Chat
 
+from .functions.database import Cache, get_database, get_rows, set_rows
+from .functions.status import UserStatus, load_status
+from .functions.structures import ExpiringMap, ReportStore, RotatingSet, ShardedMap
+
 # Enable logging
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
@@ -68,11 +76,17 @@ test_group_id: int = 0
 # [custom]
 aio: Union[bool, str] = ""
 backup: Union[bool, str] = ""
+batch: float = 0.0
 date_reset: str = ""
 default_group_link: str = ""
+digest: float = 0.0
+journal: Union[bool, str] = "False"
 limit_ban: int = 0
 project_link: str = ""
 project_name: str = ""
+save_interval: float = 3.0
+shards: int = 0
+sqlite: Union[bool, str] = "False"
 zh_cn: Union[bool, str] = ""
 
 # [encrypt]
@@ -110,11 +124,19 @@ try:
     aio = eval(aio)
     backup = config["custom"].get("backup", backup)
     backup = eval(backup)
+    batch = float(config["custom"].get("batch", batch))
     date_reset = config["custom"].get("date_reset", date_reset)
     default_group_link = config["custom"].get("default_group_link", default_group_link)
+    digest = float(config["custom"].get("digest", digest))
+    journal = config["custom"].get("journal", journal)
+    journal = eval(journal)
     limit_ban = int(config["custom"].get("limit_ban", limit_ban))
     project_link = config["custom"].get("project_link", project_link)
     project_name = config["custom"].get("project_name", project_name)
+    save_interval = float(config["custom"].get("save_interval", save_interval))
+    shards = int(config["custom"].get("shards", shards))
+    sqlite = config["custom"].get("sqlite", sqlite)
+    sqlite = eval(sqlite)
     zh_cn = config["custom"].get("zh_cn", zh_cn)
     zh_cn = eval(zh_cn)
     # [encrypt]
@@ -147,11 +169,17 @@ if (bot_token in {"", "[DATA EXPUNGED]"}
         or test_group_id == 0
         or aio not in {False, True}
         or backup not in {False, True}
+        or batch < 0
         or date_reset in {"", "[DATA EXPUNGED]"}
         or default_group_link in {"", "[DATA EXPUNGED]"}
+        or digest < 0
+        or journal not in {False, True}
         or limit_ban == 0
         or project_link in {"", "[DATA EXPUNGED]"}
         or project_name in {"", "[DATA EXPUNGED]"}
+        or save_interval < 0
+        or shards < 0
+        or sqlite not in {False, True}
         or zh_cn not in {False, True}
         or key in {b"", b"[DATA EXPUNGED]", "", "[DATA EXPUNGED]"}
         or password in {"", "[DATA EXPUNGED]"}):
@@ -168,9 +196,13 @@ lang: Dict[str, str] = {
     "action": (zh_cn and "执行操作") or "Action",
     "clear": (zh_cn and "清空数据") or "Clear Data",
     "colon": (zh_cn and "：") or ": ",
+    "declared_count": (zh_cn and "声明消息数") or "Declared Messages",
+    "declared_size": (zh_cn and "声明消息内存") or "Declared Messages Memory",
     "description": (zh_cn and "说明") or "Description",
     "disabled": (zh_cn and "禁用") or "Disabled",
     "enabled": (zh_cn and "启用") or "Enabled",
+    "flood_count": (zh_cn and "限流次数") or "Flood Waits",
+    "flood_time": (zh_cn and "限流时长") or "Flood Wait Time",
     "name": (zh_cn and "名称") or "Name",
     "reason": (zh_cn and "原因") or "Reason",
     "reset": (zh_cn and "重置数据") or "Reset Data",
@@ -316,6 +348,11 @@ lang: Dict[str, str] = {
 
 # Init
 
+admin_groups: Dict[int, Set[int]] = {}
+# admin_groups = {
+#     12345678: {-10012345678}
+# }
+
 all_commands: List[str] = [
     "admin",
     "admins",
@@ -331,9 +368,26 @@ all_commands: List[str] = [
     "warn"
 ]
 
+batch_limit: int = 4096
+
+batch_records: List[Dict[str, Union[bool, dict, int, list, str]]] = []
+# batch_records = [
+#     {
+#         "to": ["CAPTCHA", "CLEAN"],
+#         "action": "update",
+#         "type": "score",
+#         "data": {"id": 12345678, "score": 0.4}
+#     }
+# ]
+
 bot_ids: Set[int] = {avatar_id, captcha_id, clean_id, lang_id, long_id, noflood_id,
                      noporn_id, nospam_id, recheck_id, tip_id, user_id, warn_id}
 
+cache_size: int = 100000
+
+channel_ids: Set[int] = {critical_channel_id, debug_channel_id, exchange_channel_id, hide_channel_id,
+                         logging_channel_id}
+
 chats: Dict[int, Chat] = {}
 # chats = {
 #     -10012345678: Chat
@@ -346,11 +400,15 @@ counts: Dict[int, Dict[int, int]] = {}
 #     }
 # }
 
-declared_message_ids: Dict[int, Set[int]] = {}
+declared_limit: int = 1000
+
+declared_message_ids: Dict[int, RotatingSet] = {}
 # declared_message_ids = {
-#     -10012345678: {123}
+#     -10012345678: RotatingSet
 # }
 
+declared_window: float = 600.0
+
 default_config: Dict[str, Union[bool, int, Dict[str, bool]]] = {
     "default": True,
     "lock": 0,
@@ -363,40 +421,179 @@ default_config: Dict[str, Union[bool, int, Dict[str, bool]]] = {
     }
 }
 
-default_user_status: Dict[str, Union[float, Dict[Union[int, str], Union[float, int]], Set[int]]] = {
-    "ban": set(),
-    "kick": set(),
-    "lock": set(),
-    "score": {
-        "captcha": 0.0,
-        "clean": 0.0,
-        "lang": 0.0,
-        "long": 0.0,
-        "noflood": 0.0,
-        "noporn": 0.0,
-        "nospam": 0.0,
-        "recheck": 0.0,
-        "warn": 0.0
-    },
-    "warn": {},
-    "waiting": set()
-}
+delete_ids: Dict[int, Set[int]] = {}
+# delete_ids = {
+#     -10012345678: {123, 124}
+# }
+
+delete_interval: float = 0.5
+
+digest_entries: Dict[int, List[str]] = {}
+# digest_entries = {
+#     -10012345678: ["header", "entry", "entry"]
+# }
+
+flood_until: Dict[str, float] = {}
+# flood_until = {
+#     "send_message_-10012345678": 1512345678.9
+# }
+
+group_locks: List[Lock] = [Lock() for _ in range(64)]
+
+journal_count: int = 0
+
+lease_count: Iterator[int] = count(1)
+
+lease_limit: int = 1024
+
+lock_lease: float = 120.0
+
+lock_stripes: int = 64
 
 locks: Dict[str, Lock] = {
     "admin": Lock(),
-    "message": Lock(),
-    "receive": Lock()
+    "batch": Lock(),
+    "delete": Lock(),
+    "digest": Lock(),
+    "index": Lock(),
+    "journal": Lock(),
+    "lease": Lock(),
+    "ordered": Lock(),
+    "rate": Lock(),
+    "save": Lock(),
+    "score": Lock()
+}
+
+metrics: Dict[str, Union[float, int]] = {
+    "declared_count": 0,
+    "declared_size": 0,
+    "flood_count": 0,
+    "flood_time": 0.0
+}
+
+ordered_queues: Dict[str, Queue] = {}
+# ordered_queues = {
+#     "receive_MANAGE": Queue(1000)
+# }
+
+pool_count: Iterator[int] = count()
+
+pool_sizes: Dict[str, int] = {
+    "file": 2,
+    "share": 4,
+    "telegram": 16
 }
 
+pool_stopped: bool = False
+
+pool_threads: List[Thread] = []
+
+pool_timeout: float = 1.0
+
+pools: Dict[str, PriorityQueue] = {
+    "file": PriorityQueue(1000),
+    "share": PriorityQueue(1000),
+    "telegram": PriorityQueue(5000)
+}
+
+priorities: Dict[str, int] = {
+    "enforce": 0,
+    "report": 1,
+    "share": 2,
+    "debug": 3
+}
+
+priority_local: local = local()
+# priority_local.name = "report"
+
+rate_buckets: Dict[str, List[float]] = {}
+# rate_buckets = {
+#     "global": [29.0, 1512345678.9],
+#     "chat_-10012345678": [19.0, 1512345678.9],
+#     "send_message": [29.0, 1512345678.9]
+# }
+
+rate_limits: Dict[str, Tuple[float, float]] = {
+    "global": (30.0, 30.0),
+    "group": (20 / 60, 20.0),
+    "private": (1.0, 1.0),
+    "delete_messages": (10.0, 20.0),
+    "edit_message_text": (20.0, 20.0),
+    "kick_chat_member": (10.0, 20.0),
+    "send_document": (5.0, 10.0),
+    "send_message": (30.0, 30.0)
+}
+# rate_limits = {
+#     "name": (tokens per second, bucket size)
+# }
+
+rate_messages: Set[str] = {"edit_message_text", "forward_messages", "send_document", "send_message"}
+
+rate_reserves: Dict[str, float] = {
+    "enforce": 0.0,
+    "report": 0.0,
+    "share": 5.0,
+    "debug": 10.0
+}
+# rate_reserves = {
+#     "priority": global tokens left for the higher priorities
+# }
+
 receivers: Dict[str, List[str]] = {
     "score": ["ANALYZE", "CAPTCHA", "CLEAN", "LANG", "LONG", "MANAGE",
               "NOFLOOD", "NOPORN", "NOSPAM", "RECHECK", "TIP", "USER", "WARN", "WATCH"],
 }
 
+save_keys: Dict[str, Optional[Set[Union[int, str]]]] = {}
+# save_keys = {
+#     "configs": {-10012345678},
+#     "reports": None
+# }
+
+save_locks: Dict[str, Lock] = {}
+# save_locks = {
+#     "user_ids": Lock()
+# }
+
+save_pending: Set[str] = set()
+# save_pending = {"user_ids"}
+
+shard_backup: int = 0
+# shard_backup = 0b0101
+
+shard_dirty: int = 0
+# shard_dirty = 0b0010
+
+score_interval: float = 5.0
+
+score_pending: Dict[int, float] = {}
+# score_pending = {
+#     12345678: 1.3
+# }
+
 sender: str = "WARN"
 
 should_hide: bool = False
 
+timer_condition: Condition = Condition()
+
+timer_count: int = 0
+
+timer_heap: List[Tuple[float, int, str]] = []
+# timer_heap = [(1512345678.9, 3, "delete_-10012345678_123")]
+
+timer_jobs: Dict[str, Tuple[float, int, Callable, list, str, str]] = {}
+# timer_jobs = {
+#     "delete_-10012345678_123": (1512345678.9, 3, delete_messages, [client, -10012345678, [123]], "telegram", "report")
+# }
+
+user_leases: Dict[Tuple[int, int], Tuple[float, int]] = {}
+# user_leases = {
+#     (12345678, -10012345678): (1512345678.9, 3)
+# }
+
+user_locks: List[Lock] = [Lock() for _ in range(64)]
+
 usernames: Dict[str, Dict[str, Union[int, str]]] = {}
 # usernames = {
 #     "SCP_079": {
@@ -407,6 +604,9 @@ usernames: Dict[str, Dict[str, Union[int, str]]] = {}
 
 version: str = "0.3.9"
 
+waiting_ids: Set[Tuple[int, int]] = set()
+# waiting_ids = {(12345678, -10012345678)}
+
 # Load data from pickle
 
 # Init dir
@@ -441,12 +641,12 @@ message_ids: Dict[int, Tuple[int, int]] = {}
 #     -10012345678: (123, 1512345678)
 # }
 
-user_ids: Dict[int, Dict[str, Union[float, Dict[Union[int, str], Union[float, int]], Set[int]]]] = {}
+user_ids: Dict[int, UserStatus] = {}
+# The records are compact UserStatus objects, read and written like the dicts below
 # user_ids = {
 #     12345678: {
 #         "ban": {-10012345675},
 #         "kick": {-10012345676},
-#         "lock": {-10012345677},
 #         "score": {
 #             "captcha": 0.0,
 #             "clean": 0.0,
@@ -460,14 +660,13 @@ user_ids: Dict[int, Dict[str, Union[float, Dict[Union[int, str], Union[float, in
 #         }
 #         "warn": {
 #             -10012345678: 0
-#         },
-#         "waiting": {-10012345679}
+#         }
 #     }
 # }
 
-watch_ids: Dict[str, Dict[int, int]] = {
-    "ban": {},
-    "delete": {}
+watch_ids: Dict[str, ExpiringMap] = {
+    "ban": ExpiringMap(),
+    "delete": ExpiringMap()
 }
 # watch_ids = {
 #     "ban": {
@@ -494,7 +693,7 @@ configs: Dict[int, Dict[str, Union[bool, int, Dict[str, bool]]]] = {}
 #     }
 # }
 
-reports: Dict[str, Dict[str, Union[int, str]]] = {}
+reports: ReportStore = ReportStore()
 # reports = {
 #     "random": {
 #         "time": 1512345678
@@ -510,23 +709,182 @@ reports: Dict[str, Dict[str, Union[int, str]]] = {}
 # Load data
 file_list: List[str] = ["admin_ids", "bad_ids", "left_group_ids", "message_ids", "user_ids", "watch_ids",
                         "configs", "reports"]
+
+# These files are stored in the database in sqlite mode
+sqlite_list: List[str] = ["admin_ids", "configs", "reports", "user_ids", "watch_ids"]
+
+# The shards of user_ids
+shard_list: List[str] = sorted(glob("data/user_ids.[0-9]*"))
+sharded: bool = bool(shards) and not sqlite
+
+
+def dump_data(path: str, data: object) -> None:
+    # Write the data to a temp file, then atomically replace the target file
+    temp_path = path.replace("data/", "tmp/")
+
+    with open(temp_path, "wb") as f:
+        pickle.dump(data, f)
+        f.flush()
+        fsync(f.fileno())
+
+    replace(temp_path, path)
+
+
+# Migrate the data back from the database after sqlite mode is turned off
+if not sqlite and exists("data/database"):
+    try:
+        database = get_database("data/database", sqlite_list)
+
+        for file in sqlite_list:
+            data = get_rows(database, file)
+
+            if data is None:
+                raise SystemExit("[DATA CORRUPTION]")
+
+            dump_data(f"data/{file}", data)
+
+        database.close()
+        rename("data/database", "data/database.old")
+    except Exception as e:
+        logger.critical(f"Migrate database error: {e}", exc_info=True)
+        raise SystemExit("[DATA CORRUPTION]")
+
 for file in file_list:
+    # The files are replaced atomically, the backup copies of the old versions are outdated
+    try:
+        exists(f"data/.{file}") and remove(f"data/.{file}")
+    except Exception as e:
+        logger.warning(f"Remove data {file} backup error: {e}", exc_info=True)
+
+    # Only load the pickled file that has not been migrated yet
+    if sqlite and file in sqlite_list and not exists(f"data/{file}"):
+        continue
+
+    # The user_ids is stored in shards
+    if file == "user_ids" and (sharded or shard_list) and not exists(f"data/{file}"):
+        continue
+
     try:
-        try:
-            if exists(f"data/{file}") or exists(f"data/.{file}"):
-                with open(f"data/{file}", "rb") as f:
-                    locals()[f"{file}"] = pickle.load(f)
-            else:
-                with open(f"data/{file}", "wb") as f:
-                    pickle.dump(eval(f"{file}"), f)
-        except Exception as e:
-            logger.error(f"Load data {file} error: {e}", exc_info=True)
-            with open(f"data/.{file}", "rb") as f:
+        if exists(f"data/{file}"):
+            with open(f"data/{file}", "rb") as f:
                 locals()[f"{file}"] = pickle.load(f)
+        else:
+            dump_data(f"data/{file}", eval(f"{file}"))
     except Exception as e:
-        logger.critical(f"Load data {file} backup error: {e}", exc_info=True)
+        logger.critical(f"Load data {file} error: {e}", exc_info=True)
         raise SystemExit("[DATA CORRUPTION]")
 
+
+# Load the shards of user_ids
+if shard_list and not exists("data/user_ids"):
+    try:
+        for path in shard_list:
+            with open(path, "rb") as f:
+                user_ids.update(pickle.load(f))
+    except Exception as e:
+        logger.critical(f"Load shards error: {e}", exc_info=True)
+        raise SystemExit("[DATA CORRUPTION]")
+
+# Replay the journal of user_ids
+journal_list: List[str] = ["data/user_ids.log.1", "data/user_ids.log"]
+replayed: bool = any(exists(path) for path in journal_list)
+for path in journal_list:
+    if not exists(path):
+        continue
+
+    try:
+        with open(path, "rb") as f:
+            while True:
+                try:
+                    uid, status = pickle.load(f)
+                except EOFError:
+                    break
+
+                if status is None:
+                    user_ids.pop(uid, None)
+                else:
+                    user_ids[uid] = status
+    except Exception as e:
+        logger.error(f"Replay journal {path} error: {e}", exc_info=True)
+
+# Migrate the legacy dict records of user_ids to the compact records
+migrated: bool = False
+for uid, status in list(user_ids.items()):
+    if isinstance(status, dict):
+        user_ids[uid] = load_status(status)
+        migrated = True
+
+# Write user_ids in the configured layout, fold the journal into the snapshot
+if sharded:
+    user_ids = ShardedMap(shards, user_ids)
+    shard_names = [f"data/user_ids.{i}" for i in range(shards)]
+    rewrite = migrated or replayed or exists("data/user_ids") or shard_list != sorted(shard_names)
+else:
+    shard_names = []
+    rewrite = migrated or replayed or bool(shard_list)
+
+if rewrite:
+    try:
+        if sharded:
+            for i, path in enumerate(shard_names):
+                dump_data(path, user_ids.get_shard(i))
+
+            exists("data/user_ids") and rename("data/user_ids", "data/user_ids.old")
+        else:
+            dump_data("data/user_ids", user_ids)
+
+        for path in journal_list + [path for path in shard_list if path not in shard_names]:
+            exists(path) and remove(path)
+    except Exception as e:
+        logger.critical(f"Rewrite user_ids error: {e}", exc_info=True)
+        raise SystemExit("[DATA CORRUPTION]")
+
+# Ship all shards in the first backup
+if sharded:
+    shard_backup = (1 << shards) - 1
+
+# Load data from the database
+database: Optional[Connection] = None
+if sqlite:
+    try:
+        database = get_database("data/database", sqlite_list)
+
+        for file in sqlite_list:
+            # Migrate the pickled file
+            if exists(f"data/{file}"):
+                if not set_rows(database, file, eval(f"{file}")):
+                    raise SystemExit("[DATA CORRUPTION]")
+
+                rename(f"data/{file}", f"data/{file}.old")
+
+            # Users are loaded on demand
+            if file == "user_ids":
+                user_ids = Cache(database, file, load_status, cache_size)
+                continue
+
+            data = get_rows(database, file)
+
+            if data is None:
+                raise SystemExit("[DATA CORRUPTION]")
+
+            locals()[f"{file}"].update(data)
+    except Exception as e:
+        logger.critical(f"Load database error: {e}", exc_info=True)
+        raise SystemExit("[DATA CORRUPTION]")
+
+# Index the groups of each admin
+for gid, admins in admin_ids.items():
+    for uid in admins:
+        admin_groups.setdefault(uid, set()).add(gid)
+
+# Index the reports by time
+reports = ReportStore(reports)
+
+# Evict the expired watches
+for the_type in list(watch_ids):
+    watch_ids[the_type] = ExpiringMap(watch_ids[the_type])
+    watch_ids[the_type].expire()
+
 # Start program
 copyright_text = (f"SCP-079-{sender} v{version}, Copyright (C) 2019 SCP-079 <https://scp-079.org>\n"
                   "Licensed under the terms of the GNU General Public License v3 or later (GPLv3+)\n")
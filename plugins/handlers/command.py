@@ -26,11 +26,12 @@ from .. import glovar
 from ..functions.channel import get_debug_text, share_data
 from ..functions.etc import bold, button_data, code, delay, get_callback_data, get_command_context, get_command_type
 from ..functions.etc import get_full_name, get_int, get_now, lang, mention_id, thread
-from ..functions.file import save
+from ..functions.file import save, save_user
 from ..functions.filters import authorized_group, class_d, from_user, is_class_c, is_watch_user, is_high_score_user
 from ..functions.filters import is_class_e_user, test_group
 from ..functions.group import delete_message, get_config_text, get_message
 from ..functions.ids import init_user_id
+from ..functions.lock import get_group_lock, is_locked
 from ..functions.user import ban_user, forgive_user, get_admin_text, get_class_d_id, remove_user
 from ..functions.user import report_answer, report_user, unban_user, undo_user, warn_user
 from ..functions.telegram import get_group_info, resolve_username, send_message, send_report_message
@@ -68,9 +69,9 @@ def admin(client: Client, message: Message) -> bool:
             return True
 
         # Warned user and the user having report status can't mention admins
-        if (gid in glovar.user_ids[uid]["waiting"]
-                or gid in glovar.user_ids[uid]["ban"]
-                or glovar.user_ids[uid]["warn"].get(gid)):
+        if ((uid, gid) in glovar.waiting_ids
+                or gid in glovar.user_ids[uid].get("ban", ())
+                or glovar.user_ids[uid].get("warn", {}).get(gid)):
             return True
 
         # Generate report text
@@ -110,10 +111,16 @@ def admin(client: Client, message: Message) -> bool:
         if not result:
             return True
 
-        old_mid, _ = glovar.message_ids.get(gid, (0, 0))
-        old_mid and thread(delete_message, (client, gid, old_mid))
-        sent_mid = result.message_id
-        glovar.message_ids[gid] = (sent_mid, get_now())
+        lock = get_group_lock(gid)
+        lock.acquire()
+        try:
+            old_mid, _ = glovar.message_ids.get(gid, (0, 0))
+            old_mid and thread(delete_message, (client, gid, old_mid))
+            sent_mid = result.message_id
+            glovar.message_ids[gid] = (sent_mid, get_now())
+        finally:
+            lock.release()
+
         save("message_ids")
 
         return True
@@ -206,7 +213,7 @@ def config(client: Client, message: Message) -> bool:
 
         # Set lock
         glovar.configs[gid]["lock"] = now
-        save("configs")
+        save("configs", gid)
 
         # Ask CONFIG generate a config session
         group_name, group_link = get_group_info(client, message.chat)
@@ -231,14 +238,14 @@ def config(client: Client, message: Message) -> bool:
         text = get_debug_text(client, message.chat)
         text += (f"{lang('admin_group')}{lang('colon')}{code(message.from_user.id)}\n"
                  f"{lang('action')}{lang('colon')}{code(lang('config_create'))}\n")
-        thread(send_message, (client, glovar.debug_channel_id, text))
+        thread(send_message, (client, glovar.debug_channel_id, text), priority="debug")
 
         return True
     except Exception as e:
         logger.warning(f"Config error: {e}", exc_info=True)
     finally:
         if is_class_c(None, message):
-            delay(3, delete_message, [client, gid, mid])
+            delay(3, delete_message, [client, gid, mid], f"delete_{gid}_{mid}")
         else:
             delete_message(client, gid, mid)
 
@@ -338,14 +345,14 @@ def config_directly(client: Client, message: Message) -> bool:
         if success and new_config != glovar.configs[gid]:
             # Save new config
             glovar.configs[gid] = new_config
-            save("configs")
+            save("configs", gid)
 
             # Send debug message
             debug_text = get_debug_text(client, message.chat)
             debug_text += (f"{lang('admin_group')}{lang('colon')}{code(message.from_user.id)}\n"
                            f"{lang('action')}{lang('colon')}{code(lang('config_change'))}\n"
                            f"{lang('more')}{lang('colon')}{code(f'{command_type} {command_context}')}\n")
-            thread(send_message, (client, glovar.debug_channel_id, debug_text))
+            thread(send_message, (client, glovar.debug_channel_id, debug_text), priority="debug")
 
         text += (f"{lang('action')}{lang('colon')}{code(lang('config_change'))}\n"
                  f"{lang('status')}{lang('colon')}{code(reason)}\n")
@@ -388,8 +395,7 @@ def forgive(client: Client, message: Message) -> bool:
         # Forgive the user
         reason = get_command_type(message)
         text, success = forgive_user(client, message, uid, reason)
-        glovar.user_ids[uid]["lock"].discard(gid)
-        save("user_ids")
+        save_user(uid)
 
         if success:
             secs = 180
@@ -491,11 +497,11 @@ def report(client: Client, message: Message) -> bool:
                 return True
 
             # Check user status
-            bad_user = (gid in glovar.user_ids[rid]["lock"]
-                        or gid in glovar.user_ids[uid]["lock"]
-                        or gid in glovar.user_ids[rid]["waiting"]
-                        or gid in glovar.user_ids[uid]["waiting"]
-                        or gid in glovar.user_ids[uid]["ban"]
+            bad_user = (is_locked(rid, gid)
+                        or is_locked(uid, gid)
+                        or (rid, gid) in glovar.waiting_ids
+                        or (uid, gid) in glovar.waiting_ids
+                        or gid in glovar.user_ids[uid].get("ban", ())
                         or is_watch_user(message.from_user, "ban", now)
                         or is_watch_user(message.from_user, "delete", now)
                         or is_high_score_user(message.from_user))
@@ -527,7 +533,7 @@ def report(client: Client, message: Message) -> bool:
             else:
                 glovar.reports.pop(key, {})
 
-            save("reports")
+            save("reports", key)
 
         # Admin
         else:
@@ -709,9 +715,21 @@ def version(client: Client, message: Message) -> bool:
         aid = message.from_user.id
         mid = message.message_id
 
+        # Flood wait metrics
+        flood_count = glovar.metrics["flood_count"]
+        flood_time = round(glovar.metrics["flood_time"], 1)
+
+        # Declared message metrics
+        declared_count = glovar.metrics["declared_count"]
+        declared_size = f"{round(glovar.metrics['declared_size'] / 1024, 1)} KB"
+
         # Generate the text
         text = (f"{lang('admin')}{lang('colon')}{mention_id(aid)}\n\n"
-                f"{lang('version')}{lang('colon')}{bold(glovar.version)}\n")
+                f"{lang('version')}{lang('colon')}{bold(glovar.version)}\n"
+                f"{lang('flood_count')}{lang('colon')}{code(flood_count)}\n"
+                f"{lang('flood_time')}{lang('colon')}{code(flood_time)}\n"
+                f"{lang('declared_count')}{lang('colon')}{code(declared_count)}\n"
+                f"{lang('declared_size')}{lang('colon')}{code(declared_size)}\n")
 
         # Send the report message
         thread(send_message, (client, cid, text, mid))
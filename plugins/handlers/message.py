@@ -17,18 +17,20 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+from typing import Callable, Dict, Optional, Set, Tuple
 
 from pyrogram import Client, Filters, Message
 
 from .. import glovar
 from ..functions.channel import get_debug_text, update_score
-from ..functions.etc import code, delay, general_link, lang, mention_id, thread
-from ..functions.file import save
+from ..functions.etc import code, delay, general_link, lang, mention_id, ordered, thread
+from ..functions.file import save, save_user
 from ..functions.filters import authorized_group, exchange_channel, from_user, hide_channel, new_group, test_group
 from ..functions.group import leave_group
-from ..functions.ids import init_group_id
-from ..functions.receive import receive_add_bad, receive_clear_data, receive_config_commit, receive_config_reply
-from ..functions.receive import receive_config_show, receive_declared_message, receive_help_report
+from ..functions.ids import init_group_id, set_admin_ids
+from ..functions.lock import get_user_lock
+from ..functions.receive import receive_add_bad, receive_batch_data, receive_clear_data, receive_config_commit
+from ..functions.receive import receive_config_reply, receive_config_show, receive_declared_message, receive_help_report
 from ..functions.receive import receive_leave_approve, receive_refresh, receive_remove_bad, receive_remove_score
 from ..functions.receive import receive_remove_watch, receive_rollback, receive_text_data
 from ..functions.receive import receive_user_score, receive_watch_user
@@ -38,13 +40,49 @@ from ..functions.timers import backup_files
 # Enable logging
 logger = logging.getLogger(__name__)
 
+# Routes of the exchange data, a type of None matches any type
+# (sender, action, type): (function, arguments, ordered, pool, delay)
+# The ordered routes run one by one in the queue of their sender, the others run concurrently in the worker pools
+routes: Dict[Tuple[str, str, Optional[str]], Tuple[Callable, Tuple[str, ...], bool, str, int]] = {
+    ("CAPTCHA", "update", "declare"): (receive_declared_message, ("data",), False, "telegram", 0),
+    ("CAPTCHA", "update", "score"): (receive_user_score, ("sender", "data"), True, "", 0),
+    ("CONFIG", "config", "commit"): (receive_config_commit, ("data",), True, "", 0),
+    ("CONFIG", "config", "reply"): (receive_config_reply, ("client", "data"), True, "", 0),
+    ("MANAGE", "add", "bad"): (receive_add_bad, ("data",), True, "", 0),
+    ("MANAGE", "backup", "now"): (backup_files, ("client",), False, "telegram", 0),
+    ("MANAGE", "backup", "rollback"): (receive_rollback, ("client", "message", "data"), True, "", 0),
+    ("MANAGE", "clear", None): (receive_clear_data, ("client", "type", "data"), True, "", 0),
+    ("MANAGE", "config", "show"): (receive_config_show, ("client", "data"), True, "", 0),
+    ("MANAGE", "leave", "approve"): (receive_leave_approve, ("client", "data"), True, "", 0),
+    ("MANAGE", "remove", "bad"): (receive_remove_bad, ("data",), True, "", 0),
+    ("MANAGE", "remove", "score"): (receive_remove_score, ("data",), True, "", 0),
+    ("MANAGE", "remove", "watch"): (receive_remove_watch, ("data",), True, "", 0),
+    ("MANAGE", "update", "refresh"): (receive_refresh, ("client", "data"), True, "", 0),
+    ("NOSPAM", "add", "bad"): (receive_add_bad, ("data",), True, "", 0),
+    ("NOSPAM", "help", "report"): (receive_help_report, ("client", "data"), False, "telegram", 10),
+    ("WATCH", "add", "watch"): (receive_watch_user, ("data",), True, "", 0)
+}
+
+# The detection bots share the same routes
+for project in ["CLEAN", "LANG", "LONG", "NOFLOOD", "NOPORN", "NOSPAM", "RECHECK"]:
+    routes[(project, "update", "declare")] = (receive_declared_message, ("data",), False, "telegram", 0)
+    routes[(project, "update", "score")] = (receive_user_score, ("sender", "data"), True, "", 0)
+
+    if project == "NOSPAM":
+        continue
+
+    routes[(project, "add", "bad")] = (receive_add_bad, ("data",), True, "", 0)
+    routes[(project, "add", "watch")] = (receive_watch_user, ("data",), True, "", 0)
+
+# The senders that have at least one route
+senders: Set[str] = {sender for sender, _, _ in routes}
+
 
 @Client.on_message(Filters.incoming & Filters.group & Filters.new_chat_members
                    & ~test_group & ~new_group & authorized_group
                    & from_user)
 def check_join(client: Client, message: Message) -> bool:
     # Check new joined user
-    glovar.locks["message"].acquire()
     try:
         # Basic data
         gid = message.chat.id
@@ -53,22 +91,25 @@ def check_join(client: Client, message: Message) -> bool:
             # Basic data
             uid = new.id
 
-            if not glovar.user_ids.get(uid, {}):
-                continue
+            lock = get_user_lock(uid)
+            lock.acquire()
+            try:
+                if not glovar.user_ids.get(uid, {}):
+                    continue
 
-            if gid not in glovar.user_ids[uid]["ban"] and gid not in glovar.user_ids[uid]["kick"]:
-                continue
+                if gid not in glovar.user_ids[uid].get("ban", ()) and gid not in glovar.user_ids[uid].get("kick", ()):
+                    continue
 
-            glovar.user_ids[uid]["ban"].discard(gid)
-            glovar.user_ids[uid]["kick"].discard(gid)
-            save("user_ids")
-            update_score(client, uid)
+                glovar.user_ids[uid].get("ban", set()).discard(gid)
+                glovar.user_ids[uid].get("kick", set()).discard(gid)
+                save_user(uid)
+                update_score(client, uid)
+            finally:
+                lock.release()
 
         return True
     except Exception as e:
         logger.warning(f"Check join error: {e}", exc_info=True)
-    finally:
-        glovar.locks["message"].release()
 
     return False
 
@@ -109,7 +150,7 @@ def exchange_emergency(client: Client, message: Message) -> bool:
         text = (f"{lang('project')}{lang('colon')}{project_text}\n"
                 f"{lang('action')}{lang('colon')}{code(lang('transfer_channel'))}\n"
                 f"{lang('emergency_channel')}{lang('colon')}{code(hide_text)}\n")
-        thread(send_message, (client, glovar.debug_channel_id, text))
+        thread(send_message, (client, glovar.debug_channel_id, text), priority="debug")
 
         return True
     except Exception as e:
@@ -146,10 +187,10 @@ def init_group(client: Client, message: Message) -> bool:
             admin_members = get_admins(client, gid)
 
             if admin_members:
-                glovar.admin_ids[gid] = {admin.user.id for admin in admin_members
-                                         if ((not admin.user.is_bot and not admin.user.is_deleted)
-                                             or admin.user.id in glovar.bot_ids)}
-                save("admin_ids")
+                set_admin_ids(gid, {admin.user.id for admin in admin_members
+                                    if ((not admin.user.is_bot and not admin.user.is_deleted)
+                                        or admin.user.id in glovar.bot_ids)})
+                save("admin_ids", gid)
                 text += f"{lang('status')}{lang('colon')}{code(lang('status_joined'))}\n"
             else:
                 thread(leave_group, (client, gid))
@@ -171,7 +212,7 @@ def init_group(client: Client, message: Message) -> bool:
             text += f"{lang('inviter')}{lang('colon')}{code(inviter.id)}\n"
 
         # Send debug message
-        thread(send_message, (client, glovar.debug_channel_id, text))
+        thread(send_message, (client, glovar.debug_channel_id, text), priority="debug")
 
         return True
     except Exception as e:
@@ -185,186 +226,49 @@ def init_group(client: Client, message: Message) -> bool:
                    & exchange_channel)
 def process_data(client: Client, message: Message) -> bool:
     # Process the data in exchange channel
-    glovar.locks["receive"].acquire()
     try:
         data = receive_text_data(message)
 
         if not data:
             return True
 
-        sender = data["from"]
-        receivers = data["to"]
-        action = data["action"]
-        action_type = data["type"]
-        data = data["data"]
+        # A batch carries many records
+        for record in receive_batch_data(client, message, data, senders):
+            sender = record["from"]
+            receivers = record["to"]
+            action = record["action"]
+            action_type = record["type"]
+            data = record["data"]
+
+            if glovar.sender not in receivers:
+                continue
+
+            # Only the listed routes are permitted
+            route = routes.get((sender, action, action_type)) or routes.get((sender, action, None))
 
-        # This will look awkward,
-        # seems like it can be simplified,
-        # but this is to ensure that the permissions are clear,
-        # so it is intentionally written like this
-        if glovar.sender in receivers:
-
-            if sender == "CAPTCHA":
-
-                if action == "update":
-                    if action_type == "declare":
-                        receive_declared_message(data)
-                    elif action_type == "score":
-                        receive_user_score(sender, data)
-
-            elif sender == "CLEAN":
-
-                if action == "add":
-                    if action_type == "bad":
-                        receive_add_bad(data)
-                    elif action_type == "watch":
-                        receive_watch_user(data)
-
-                elif action == "update":
-                    if action_type == "declare":
-                        receive_declared_message(data)
-                    elif action_type == "score":
-                        receive_user_score(sender, data)
-
-            elif sender == "CONFIG":
-
-                if action == "config":
-                    if action_type == "commit":
-                        receive_config_commit(data)
-                    elif action_type == "reply":
-                        receive_config_reply(client, data)
-
-            elif sender == "LANG":
-
-                if action == "add":
-                    if action_type == "bad":
-                        receive_add_bad(data)
-                    elif action_type == "watch":
-                        receive_watch_user(data)
-
-                elif action == "update":
-                    if action_type == "declare":
-                        receive_declared_message(data)
-                    elif action_type == "score":
-                        receive_user_score(sender, data)
-
-            elif sender == "LONG":
-
-                if action == "add":
-                    if action_type == "bad":
-                        receive_add_bad(data)
-                    elif action_type == "watch":
-                        receive_watch_user(data)
-
-                elif action == "update":
-                    if action_type == "declare":
-                        receive_declared_message(data)
-                    elif action_type == "score":
-                        receive_user_score(sender, data)
-
-            elif sender == "MANAGE":
-
-                if action == "add":
-                    if action_type == "bad":
-                        receive_add_bad(data)
-
-                elif action == "backup":
-                    if action_type == "now":
-                        thread(backup_files, (client,))
-                    elif action_type == "rollback":
-                        receive_rollback(client, message, data)
-
-                elif action == "clear":
-                    receive_clear_data(client, action_type, data)
-
-                elif action == "config":
-                    if action_type == "show":
-                        receive_config_show(client, data)
-
-                elif action == "leave":
-                    if action_type == "approve":
-                        receive_leave_approve(client, data)
-
-                elif action == "remove":
-                    if action_type == "bad":
-                        receive_remove_bad(data)
-                    elif action_type == "score":
-                        receive_remove_score(data)
-                    elif action_type == "watch":
-                        receive_remove_watch(data)
-
-                elif action == "update":
-                    if action_type == "refresh":
-                        receive_refresh(client, data)
-
-            elif sender == "NOFLOOD":
-
-                if action == "add":
-                    if action_type == "bad":
-                        receive_add_bad(data)
-                    elif action_type == "watch":
-                        receive_watch_user(data)
-
-                elif action == "update":
-                    if action_type == "declare":
-                        receive_declared_message(data)
-                    elif action_type == "score":
-                        receive_user_score(sender, data)
-
-            elif sender == "NOPORN":
-
-                if action == "add":
-                    if action_type == "bad":
-                        receive_add_bad(data)
-                    elif action_type == "watch":
-                        receive_watch_user(data)
-
-                elif action == "update":
-                    if action_type == "declare":
-                        receive_declared_message(data)
-                    elif action_type == "score":
-                        receive_user_score(sender, data)
-
-            elif sender == "NOSPAM":
-
-                if action == "add":
-                    if action_type == "bad":
-                        receive_add_bad(data)
-
-                elif action == "help":
-                    if action_type == "report":
-                        delay(10, receive_help_report, [client, data])
-                
-                elif action == "update":
-                    if action_type == "declare":
-                        receive_declared_message(data)
-                    elif action_type == "score":
-                        receive_user_score(sender, data)
-            
-            elif sender == "RECHECK":
-
-                if action == "add":
-                    if action_type == "bad":
-                        receive_add_bad(data)
-                    elif action_type == "watch":
-                        receive_watch_user(data)
-
-                elif action == "update":
-                    if action_type == "declare":
-                        receive_declared_message(data)
-                    elif action_type == "score":
-                        receive_user_score(sender, data)
-            
-            elif sender == "WATCH":
-
-                if action == "add":
-                    if action_type == "watch":
-                        receive_watch_user(data)
+            if not route:
+                continue
+
+            target, names, in_order, pool, secs = route
+            values = {
+                "client": client,
+                "message": message,
+                "sender": sender,
+                "type": action_type,
+                "data": data
+            }
+            args = [values[name] for name in names]
+
+            # The ordered routes of a sender run one by one, other senders are not held back
+            if in_order:
+                ordered(f"receive_{sender}", target, tuple(args))
+            elif secs:
+                delay(secs, target, args, pool=pool)
+            else:
+                thread(target, tuple(args), pool)
 
         return True
     except Exception as e:
         logger.warning(f"Process data error: {e}", exc_info=True)
-    finally:
-        glovar.locks["receive"].release()
 
     return False